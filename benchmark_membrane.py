@@ -0,0 +1,313 @@
+# Benchmark of the membrane refinement of pick_membrane.py on synthetic
+# micrographs, runnable offline without cryoSPARC or vesicle-picker.
+# Each micrograph holds non-overlapping vesicles whose membranes are two dark
+# leaflets 25 to 45 A apart, with Gaussian noise, and vesicle masks of perturbed
+# radius at the downsampled resolution whose contours are found as in
+# vesicle_picker.postprocess.find_contour. Every combination of the given vesicle
+# counts, image sizes and hist_endpoints is refined, and reported with per-stage
+# throughput, peak memory, and the accuracy of picks and splines against the
+# known membrane radii, optionally compared with an earlier run's results.
+
+
+# Imports
+from membrane_refinement import RefinementParameters, refine_micrograph
+from membrane_metrics import Metrics
+from pick_store import save_pick_store
+from argparse import ArgumentParser
+from itertools import product
+from tempfile import TemporaryDirectory
+import numpy as np
+import cv2
+import json
+import time
+import tracemalloc
+
+
+def parse_args():
+    # Parse command line arguments
+    parser = ArgumentParser(
+        prog="benchmark_membrane.py",
+        description="Benchmark membrane refinement on synthetic micrographs with known membranes"
+    )
+    parser.add_argument(
+        "--vesicles",
+        type=int,
+        nargs="+",
+        default=[16],
+        help="Numbers of vesicles per micrograph to benchmark"
+    )
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs="+",
+        default=[2048],
+        help="Widths and heights in pixels of the square micrographs to benchmark"
+    )
+    parser.add_argument(
+        "--hist_endpoints",
+        type=int,
+        nargs="+",
+        default=[90],
+        help="Distances in A for histograms to extend from the membrane to benchmark"
+    )
+    parser.add_argument(
+        "--micrographs",
+        type=int,
+        default=4,
+        help="Number of synthetic micrographs refined for each combination"
+    )
+    parser.add_argument(
+        "--psize",
+        type=float,
+        default=1.0,
+        help="Width of each pixel, in A"
+    )
+    parser.add_argument(
+        "--radius",
+        type=float,
+        nargs=2,
+        default=[100, 300],
+        help="Minimum and maximum radius in A of the intermembrane space of each vesicle"
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=2.0,
+        help="Standard deviation of the Gaussian noise, relative to the depth of each leaflet"
+    )
+    parser.add_argument(
+        "--mask_error",
+        type=float,
+        default=20,
+        help="Maximum error in A of the radius of each vesicle's mask"
+    )
+    parser.add_argument(
+        "--downsample",
+        type=int,
+        default=4,
+        help="Downsampling of the masks relative to the micrographs"
+    )
+    parser.add_argument(
+        "--contour_spacing",
+        type=float,
+        default=50,
+        help="Separation in A between sample points on vesicle contours"
+    )
+    parser.add_argument(
+        "--exact_profiles",
+        action="store_true",
+        help="Bin every pixel in each segment's rectangle instead of sampling along segment normals (slower)"
+    )
+    parser.add_argument(
+        "--coarse_binning",
+        type=int,
+        default=None,
+        help="Find each segment's approximate membrane offset on the micrograph binned by this factor, then detect bilayers at full resolution only within --fine_window of it. Not used with --exact_profiles"
+    )
+    parser.add_argument(
+        "--fine_window",
+        type=float,
+        default=40,
+        help="Distance in A either side of the approximate membrane offset to detect bilayers within, with --coarse_binning"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed refinements of each micrograph, of which the fastest is reported. Peak memory is measured in one further refinement"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the synthetic micrographs, which are the same for every run with the same seed"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON-lines file to write the results of each combination to"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="JSON-lines results of an earlier run to compare the throughput and accuracy of each combination with"
+    )
+    return parser.parse_args()
+
+def place_vesicles(rng, n_vesicles, shape, radius_range, margin):
+    # Place up to n_vesicles non-overlapping circles of random radius within the image, at least margin
+    # px from its edges and from each other
+    # Returns an (n, 2) array of (x, y) centers and an (n,) array of radii, in px
+    centers = []
+    radii = []
+    for _ in range(100 * n_vesicles):
+        if len(centers) == n_vesicles:
+            break
+        radius = rng.uniform(*radius_range)
+        if 2 * (radius + margin) >= min(shape):
+            continue
+        center = rng.uniform(radius + margin, np.array(shape[::-1]) - radius - margin)
+        if all(np.linalg.norm(center - other) > radius + other_radius + margin
+               for other, other_radius in zip(centers, radii)):
+            centers.append(center)
+            radii.append(radius)
+    return np.array(centers).reshape(-1, 2), np.array(radii)
+
+def synthetic_micrograph(rng, n_vesicles, size, args):
+    # Generate a micrograph with vesicles whose leaflets are dark Gaussian lines, and their masks
+    # Returns the image, the downsampled masks, and the ground truth (x, y) centers in px, and the
+    # (n, 3) inner leaflet, intermembrane, and outer leaflet radii in px
+    shape = (size, size)
+    # Keep every sampled distance from the membranes within the image and clear of other vesicles
+    margin = (max(args.hist_endpoints) + 20) / args.psize
+    centers, radii = place_vesicles(rng, n_vesicles, shape, np.array(args.radius) / args.psize, margin)
+    separations = rng.uniform(25, 45, len(radii)) / args.psize
+    leaflet_width = 3 / args.psize
+    image = rng.normal(0, args.noise, shape).astype(np.float32)
+    y, x = np.mgrid[:size, :size]
+    masks = []
+    for center, radius, separation in zip(centers, radii, separations):
+        # Only draw the box around each vesicle
+        extent = int(radius + separation + 5 * leaflet_width) + 1
+        x0, y0 = np.maximum(np.floor(center).astype(int) - extent, 0)
+        x1, y1 = np.minimum(np.floor(center).astype(int) + extent + 1, size)
+        r = np.hypot(x[y0:y1, x0:x1] - center[0], y[y0:y1, x0:x1] - center[1])
+        for leaflet_radius in (radius - separation / 2, radius + separation / 2):
+            image[y0:y1, x0:x1] -= np.exp(-0.5 * ((r - leaflet_radius) / leaflet_width) ** 2)
+        # Mask the vesicle to a perturbed radius at the downsampled resolution
+        mask_radius = (radius + rng.uniform(-1, 1) * args.mask_error / args.psize) / args.downsample
+        mask = np.zeros((size // args.downsample, size // args.downsample), dtype=np.uint8)
+        cv2.circle(mask, tuple(np.round(center / args.downsample).astype(int)), int(round(mask_radius)), 1, -1)
+        masks.append(mask)
+    truth = np.stack((radii - separations / 2, radii, radii + separations / 2), axis=1)
+    return image, masks, centers, truth
+
+def mask_contours(masks, downsample, metrics):
+    # Find the contour of each mask as pick_membrane.py does, reversing downsampling
+    with metrics.stage("find_contours"):
+        contours = [cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0][0].squeeze(1) * downsample
+                    for mask in masks]
+    return contours
+
+def radial_errors(points, centers, truth, layer, psize):
+    # Return the distance in A of each (x, y) point from the nearest true membrane of the given layer
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0 or len(centers) == 0:
+        return np.empty(0)
+    distances = np.linalg.norm(points[:, None, :] - centers[None, :, :], axis=2)
+    return psize * np.min(np.abs(distances - truth[None, :, layer]), axis=1)
+
+def accuracy(result, centers, truth, psize):
+    # Return the median error in A of the cleaned picks and spline points of each layer, and the fraction
+    # within 5 A, against the true membranes, and the fraction of vesicles with cleaned picks
+    summary = {"vesicles_picked": np.mean([len(edge) > 0 for edge in result.picks_cleaned])}
+    for l, layer in enumerate(("inner", "intermembrane", "outer")):
+        pick_errors = radial_errors(np.concatenate([np.empty((0, 2))] + [edge[:, l] for edge in result.picks_cleaned]),
+                                    centers, truth, l, psize)
+        spline_errors = radial_errors(np.concatenate([np.empty((0, 2))] + [splines[l] for splines in result.splines]),
+                                      centers, truth, l, psize)
+        summary[f"pick_error_{layer}"] = np.median(pick_errors) if len(pick_errors) else np.nan
+        summary[f"spline_error_{layer}"] = np.median(spline_errors) if len(spline_errors) else np.nan
+        summary[f"spline_within_5A_{layer}"] = np.mean(spline_errors <= 5) if len(spline_errors) else np.nan
+    return summary
+
+def refine_synthetic(image, masks, params, downsample, spline_dir):
+    # Run the stages of pick_membrane.py on one synthetic micrograph
+    # Returns the MicrographRefinement
+    metrics = Metrics()
+    contours = mask_contours(masks, downsample, metrics)
+    result = refine_micrograph(image, contours, params, metrics=metrics)
+    with metrics.stage("save_splines"):
+        save_pick_store(spline_dir, 0, result.splines)
+    return result
+
+def benchmark(micrographs, params, args, spline_dir):
+    # Refine each micrograph args.repeats times, keeping the metrics of the fastest refinement, then once
+    # more to measure peak memory
+    # Returns a dict of throughputs, mean per micrograph stage times, peak memory and accuracy
+    totals = {}
+    accuracies = []
+    wall = 0.0
+    for image, masks, centers, truth in micrographs:
+        best = None
+        for _ in range(args.repeats):
+            t = time.perf_counter()
+            result = refine_synthetic(image, masks, params, args.downsample, spline_dir)
+            t = time.perf_counter() - t
+            if best is None or t < best[0]:
+                best = (t, result)
+        wall += best[0]
+        for name, value in best[1].metrics.record().items():
+            totals[name] = totals.get(name, 0) + value
+        accuracies.append(accuracy(best[1], centers, truth, args.psize))
+    tracemalloc.start()
+    for image, masks, centers, truth in micrographs:
+        refine_synthetic(image, masks, params, args.downsample, spline_dir)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    n = len(micrographs)
+    summary = {
+        "micrographs_per_s": n / wall,
+        "segments_per_s": totals.get("count/segments_considered", 0) / wall,
+        "profiled_segments_per_s": (totals.get("count/segments_considered", 0) - totals.get("count/segments_skipped", 0))
+                                   / max(totals.get("wall/segment_profiles", 0), 1e-9),
+        "peak_memory_mb": peak / 1e6,
+    }
+    summary.update((name, value / n) for name, value in totals.items() if name.startswith("wall/"))
+    summary.update((name, value) for name, value in totals.items() if name.startswith("count/"))
+    for name in accuracies[0]:
+        summary[name] = float(np.nanmean([a[name] for a in accuracies]))
+    return summary
+
+def load_baseline(path):
+    # Return the results of an earlier run by their (vesicles, image_size, hist_endpoints)
+    with open(path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    return {(r["vesicles"], r["image_size"], r["hist_endpoints"]): r for r in results}
+
+def report(result, baseline=None):
+    # Print the results of one combination, with the change from the baseline if given
+    print(f"vesicles={result['vesicles']} image_size={result['image_size']} hist_endpoints={result['hist_endpoints']}")
+    for name, value in result.items():
+        if name in ("vesicles", "image_size", "hist_endpoints"):
+            continue
+        line = f"  {name}: {value:.4g}"
+        if baseline is not None and isinstance(baseline.get(name), (int, float)) and baseline[name] != 0:
+            line += f" ({value / baseline[name]:.2f}x baseline)"
+        print(line)
+
+def main():
+    args = parse_args()
+    baselines = {} if args.baseline is None else load_baseline(args.baseline)
+    output = None if args.output is None else open(args.output, 'w')
+    with TemporaryDirectory() as spline_dir:
+        for n_vesicles, size in product(args.vesicles, args.image_size):
+            # Generate the micrographs once for every hist_endpoints, from a seed fixed per combination
+            rng = np.random.default_rng([args.seed, n_vesicles, size])
+            micrographs = [synthetic_micrograph(rng, n_vesicles, size, args) for _ in range(args.micrographs)]
+            placed = sum(len(centers) for _, _, centers, _ in micrographs)
+            if placed < n_vesicles * args.micrographs:
+                print(f"Placed {placed} of {n_vesicles * args.micrographs} vesicles in {size} px micrographs")
+            for hist_endpoints in args.hist_endpoints:
+                params = RefinementParameters(
+                    psize=args.psize,
+                    contour_spacing=args.contour_spacing,
+                    hist_offset=hist_endpoints,
+                    exact_profiles=args.exact_profiles,
+                    coarse_binning=args.coarse_binning,
+                    fine_window=args.fine_window
+                )
+                result = {"vesicles": n_vesicles, "image_size": size, "hist_endpoints": hist_endpoints}
+                result.update(benchmark(micrographs, params, args, spline_dir))
+                report(result, baselines.get((n_vesicles, size, hist_endpoints)))
+                if output is not None:
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+    if output is not None:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
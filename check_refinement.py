@@ -0,0 +1,48 @@
+# Regression check of the membrane refinement of pick_membrane.py, runnable
+# offline without cryoSPARC or vesicle-picker. Runs the inputs that have crashed
+# refinement before on random micrographs, and exits with the error of any that
+# still does.
+
+
+# Imports
+from membrane_refinement import segment_profiles, coarse_membrane_offsets
+from argparse import ArgumentParser
+import numpy as np
+
+
+def parse_args():
+    # Parse command line arguments
+    parser = ArgumentParser(
+        prog="check_refinement.py",
+        description="Check membrane refinement on inputs that have crashed it before"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the random micrographs and segments"
+    )
+    return parser.parse_args()
+
+def check_remap_limit(rng):
+    # Profile thousands of segments with few bins, as in the coarse pass or with small hist_endpoints,
+    # which once exceeded the largest map cv2.remap accepts
+    image = rng.normal(size=(4096, 4096)).astype(np.float32)
+    p1 = rng.uniform(200, 3800, (6000, 2))
+    angles = rng.uniform(0, 2 * np.pi, len(p1))
+    p2 = p1 + 50 * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    for binning in (4, 6, 8):
+        coarse_membrane_offsets(image, p1, p2, 1.0, 90, binning, 40)
+    for hist_endpoints in (5, 15):
+        segment_profiles(image, p1, p2, 1.0, hist_endpoints)
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    for name, check in [("remap_limit", check_remap_limit)]:
+        check(rng)
+        print(f"Passed {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 # Expand the spline generated by pick_membrane.py or repick_membrane.py by
 # a specified distance
 
+from membrane_masks import dilate_points, mask_coordinates
+from membrane_pipeline import map_micrographs, save_atomic
+from pick_store import index_pick_files, load_pick_array
 import numpy as np
 from argparse import ArgumentParser
 import sys
@@ -8,87 +11,124 @@ import os
 from pathlib import Path
 
 
-# Parse command line arguments
-parser = ArgumentParser(
-    prog="dilate_picks.py",
-    description="Expand a spline of membrane coordinates to a band, by dilating each coordinate to a circle centered around it"
-)
-parser.add_argument(
-    "picks_dir", 
-    type=str,
-    help="Directory containing npy arrays of membrane coordinates"
-)
-parser.add_argument(
-    "psize",
-    type=float,
-    help="Width of each pixel, in A"
-)
-parser.add_argument(
-    "pixels_x",
-    type=int,
-    help="Number of pixels in the image x direction"
-)
-parser.add_argument(
-    "pixels_y",
-    type=int,
-    help="Number of pixels in the image y direction"
-)
-parser.add_argument(
-    "out_dir",
-    type=str,
-    help="Directory to store npy arrays of dilated coordinates"
-)
-parser.add_argument(
-    "--membrane_width",
-    type=float,
-    help="Width of the membrane and dilation diameter for pick coordinates, in A",
-    default=8
-)
+def parse_args():
+    # Parse command line arguments
+    parser = ArgumentParser(
+        prog="dilate_picks.py",
+        description="Expand a spline of membrane coordinates to a band, by dilating each coordinate to a circle centered around it"
+    )
+    parser.add_argument(
+        "picks_dir",
+        type=str,
+        help="Directory containing npy arrays of membrane coordinates, named {uid}_vesicle_{index}_{layer}.npy, or stores of each micrograph's coordinates"
+    )
+    parser.add_argument(
+        "psize",
+        type=float,
+        help="Width of each pixel, in A"
+    )
+    parser.add_argument(
+        "pixels_x",
+        type=int,
+        help="Number of pixels in the image x direction"
+    )
+    parser.add_argument(
+        "pixels_y",
+        type=int,
+        help="Number of pixels in the image y direction"
+    )
+    parser.add_argument(
+        "out_dir",
+        type=str,
+        help="Directory to store npy arrays of dilated coordinates"
+    )
+    parser.add_argument(
+        "--membrane_width",
+        type=float,
+        help="Width of the membrane and dilation diameter for pick coordinates, in A",
+        default=8
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["coordinates", "mask", "bitmask"],
+        default="coordinates",
+        help="Save dilated coordinates as npy arrays, or the dilated mask of each spline's bounding box with its (x, y) origin as npz archives, either as a bool array or as bits packed along x"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes dilating micrographs' picks in parallel"
+    )
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Skip picks whose dilated output already exists, to resume an interrupted run"
+    )
+    return parser.parse_args()
 
-args = parser.parse_args()
-picks_dir = args.picks_dir
-psize = args.psize
-pixels_x = args.pixels_x
-pixels_y = args.pixels_y
-out_dir = args.out_dir
-dilation_radius = args.membrane_width / (2 * psize)
+# Per process state for dilating picks, set by init_worker
+worker_state = {}
 
+def init_worker(args):
+    # Store the arguments once in each process dilating picks
+    worker_state["args"] = args
+    worker_state["dilation_radius"] = args.membrane_width / (2 * args.psize)
 
-picks_dir_files = [entry for entry in os.scandir(picks_dir) if entry.is_file()]
-picks_dir_filenames = [entry.name for entry in picks_dir_files]
-vesicles = set("_".join(entry.name.split("_")[:-1]) for entry in picks_dir_files if entry.name.endswith(".npy"))
-picks_dir_path = Path(picks_dir)
-out_dir_path = Path(out_dir)
-for vesicle in vesicles:
-    inner_picks_file = f"{vesicle}_inner.npy"
-    if inner_picks_file not in picks_dir_filenames:
-        print(f"Missing file {inner_picks_file}", file=sys.stderr)
-    else:
-        inner_picks = np.load(picks_dir_path / inner_picks_file)
-        inner_dilated = set()
-        for particle in inner_picks:
-            for deltaX in range(-int(dilation_radius), int(dilation_radius) + 1):
-                maxY = (dilation_radius ** 2 - deltaX ** 2) ** 0.5
-                for deltaY in range(-int(maxY), int(maxY) + 1):
-                    if 0 <= particle[0] + deltaX < pixels_x and 0 <= particle[1] + deltaY < pixels_y:
-                        inner_dilated.add((particle[0] + deltaX, particle[1] + deltaY))
-        inner_dilated = np.array(list(inner_dilated))
-        np.save(out_dir_path / f"{vesicle}_inner_dilated.npy", inner_dilated)
-    
-    outer_picks_file = f"{vesicle}_outer.npy"
-    if outer_picks_file not in picks_dir_filenames:
-        print(f"Missing file {outer_picks_file}", file=sys.stderr)
+def dilated_path(vesicle, layer):
+    # Return the output file of the dilated picks of one layer of a vesicle, as {uid}_vesicle_{index}
+    args = worker_state["args"]
+    suffix = {"coordinates": ".npy", "mask": "_mask.npz", "bitmask": "_bitmask.npz"}[args.output_format]
+    return Path(args.out_dir) / f"{vesicle}_{layer}_dilated{suffix}"
+
+def save_dilated(path, mask, origin):
+    # Save a dilated mask with the given origin in the requested output format
+    output_format = worker_state["args"].output_format
+    if output_format == "coordinates":
+        save_atomic(path, np.save, mask_coordinates(mask, origin))
+    elif output_format == "mask":
+        save_atomic(path, np.savez, mask=mask.astype(bool), origin=origin)
     else:
-        outer_picks = np.load(picks_dir_path / outer_picks_file)
-        outer_dilated = set()
-        for particle in outer_picks:
-            for deltaX in range(-int(dilation_radius), int(dilation_radius) + 1):
-                maxY = (dilation_radius ** 2 - deltaX ** 2) ** 0.5
-                for deltaY in range(-int(maxY), int(maxY) + 1):
-                    if 0 <= particle[0] + deltaX < pixels_x and 0 <= particle[1] + deltaY < pixels_y:
-                        outer_dilated.add((particle[0] + deltaX, particle[1] + deltaY))
-        outer_dilated = np.array(list(outer_dilated))
-        np.save(out_dir_path / f"{vesicle}_outer_dilated.npy", outer_dilated)
+        save_atomic(path, np.savez, bits=np.packbits(mask, axis=1), origin=origin, shape=mask.shape)
+
+def load_picks(uid, vesicles):
+    # Load the inner and outer membrane picks of all vesicles of one micrograph
+    # Returns a list of (vesicle, layer, picks), skipping layers already dilated if requested
+    args = worker_state["args"]
+    loaded = []
+    for index in sorted(vesicles):
+        vesicle = f"{uid}_vesicle_{index}"
+        for layer in ("inner", "outer"):
+            if layer not in vesicles[index]:
+                print(f"Missing file {vesicle}_{layer}.npy", file=sys.stderr)
+                continue
+            if args.skip_existing and os.path.isfile(dilated_path(vesicle, layer)):
+                continue
+            loaded.append((vesicle, layer, load_pick_array(vesicles[index][layer], shape=(args.pixels_y, args.pixels_x))))
+    return loaded
+
+def dilate_picks(uid, vesicles, loaded):
+    # Dilate and save the loaded picks of one micrograph
+    args = worker_state["args"]
+    for vesicle, layer, picks in loaded:
+        dilated, origin = dilate_points(picks, worker_state["dilation_radius"], (args.pixels_y, args.pixels_x))
+        save_dilated(dilated_path(vesicle, layer), dilated, origin)
+
+def main():
+    args = parse_args()
+    init_worker(args)
+
+    # Index the picks by micrograph once, and dilate each micrograph's picks as one task
+    index = index_pick_files(args.picks_dir)
+    tasks = [(uid, index[uid]) for uid in sorted(index)]
+    for _ in map_micrographs(load_picks, dilate_picks, tasks, args.workers,
+                             initializer=init_worker, initargs=(args,)):
+        pass
+
+
+if __name__ == "__main__":
+    main()
 
 
 # Optional: After generating splines, return here and run this code to repick the membrane from those splines
@@ -0,0 +1,108 @@
+# Local stand-in for the cryoSPARC project used by pick_membrane.py and
+# repick_membrane.py, for running on nodes without access to cryoSPARC. With
+# --local, micrographs are listed by a manifest .cs file of the micrographs
+# Dataset, such as the exposures output of the curate job, and read from MRC files
+# in a local directory. Picks are written to {output}.cs files in a local
+# directory, to be pushed to cryoSPARC afterwards by upload_picks.py.
+
+
+# Imports
+from vesicle_picker import external_import
+from cryosparc.tools import Dataset
+from cryosparc import mrc
+from membrane_pipeline import save_atomic
+from pathlib import Path
+
+
+class LocalProject:
+    # Project reading micrographs from a local directory and saving external job outputs to another
+    def __init__(self, micrograph_dir, output_dir):
+        self.micrograph_dir = Path(micrograph_dir)
+        self.output_dir = Path(output_dir)
+
+    def micrograph_file(self, micrograph_path):
+        # Return the local MRC file of a micrograph, at its project relative path in the micrograph
+        # directory, or else directly in the micrograph directory
+        path = self.micrograph_dir / micrograph_path
+        if not path.is_file():
+            path = self.micrograph_dir / Path(micrograph_path).name
+        return path
+
+    def download_mrc(self, micrograph_path):
+        # Return the header and data of a micrograph as cryosparc's Project.download_mrc does
+        return mrc.read(self.micrograph_file(micrograph_path))
+
+    def create_external_job(self, workspace_uid, title=None):
+        # Return a job saving its outputs to the output directory
+        return LocalJob(self.output_dir)
+
+
+class LocalJob:
+    # External job saving each output Dataset to {output_dir}/{name}.cs
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.outputs = []
+
+    def add_output(self, type, name, slots=None):
+        self.outputs.append(name)
+
+    def start(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def save_output(self, name, dataset):
+        save_atomic(self.output_dir / f"{name}.cs", lambda f: dataset.save(f))
+
+    def stop(self):
+        pass
+
+
+def add_local_arguments(parser):
+    # Add the command line arguments for running without access to cryoSPARC
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Run without access to cryoSPARC, reading micrographs from --micrograph_dir as listed by --manifest, and saving picks to --output_dir"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="With --local, .cs file of the micrographs to pick, such as the exposures output of the job in the csparc_input parameters"
+    )
+    parser.add_argument(
+        "--micrograph_dir",
+        type=str,
+        default=None,
+        help="With --local, directory containing the micrographs' MRC files, at their micrograph_blob/path relative to it or directly inside it"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="With --local, directory to save the picks to as {output}.cs files, for upload_picks.py to push to cryoSPARC"
+    )
+
+def check_local_arguments(parser, args):
+    # Exit with an error if --local is missing its inputs or outputs
+    if args.local and None in (args.manifest, args.micrograph_dir, args.output_dir):
+        parser.error("--local requires --manifest, --micrograph_dir and --output_dir")
+
+def open_project(args, parameters):
+    # Return a cryosparc session and the project of the csparc_input parameters, or with --local, no
+    # session and a LocalProject
+    if args.local:
+        return None, LocalProject(args.micrograph_dir, args.output_dir)
+    cs = external_import.load_cryosparc(parameters.get('csparc_input', 'login'))
+    return cs, cs.find_project(parameters.get("csparc_input", "PID"))
+
+def load_micrographs(args, parameters, cs):
+    # Return the micrographs Dataset of the job in the csparc_input parameters, or with --local, of
+    # the manifest
+    if args.local:
+        return Dataset.load(args.manifest)
+    return external_import.micrographs_from_csparc(
+        cs=cs,
+        project_id=parameters.get('csparc_input', 'PID'),
+        job_id=parameters.get('csparc_input', 'JID'),
+        job_type=parameters.get('csparc_input', 'type')
+    )
@@ -0,0 +1,58 @@
+# Rasterization of membrane picks into masks, shared by dilate_picks.py. Masks
+# cover only the bounding box of the picks they are drawn from, and are stored
+# with the (x, y) pixel coordinates of their first element as their origin.
+
+
+# Imports
+import numpy as np
+import cv2
+
+
+def dilation_kernel(radius):
+    # Return a uint8 disk of the offsets within radius px of its center pixel, as in the
+    # original per pick dilation: offsets (dx, dy) with |dy| <= int(sqrt(radius ** 2 - dx ** 2))
+    r = int(radius)
+    kernel = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+    for dx in range(-r, r + 1):
+        max_dy = int((radius ** 2 - dx ** 2) ** 0.5)
+        kernel[r - max_dy:r + max_dy + 1, r + dx] = 1
+    return kernel
+
+def rasterize_points(points, padding=0):
+    # Draw integer (x, y) points into a uint8 mask of their bounding box, padded by padding px
+    # on every side
+    # Returns the mask, indexed [y, x], and the (x, y) coordinates of its origin
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros((0, 0), dtype=np.uint8), np.zeros(2, dtype=int)
+    origin = points.min(axis=0) - padding
+    size = points.max(axis=0) + padding + 1 - origin
+    mask = np.zeros((size[1], size[0]), dtype=np.uint8)
+    mask[points[:, 1] - origin[1], points[:, 0] - origin[0]] = 1
+    return mask, origin
+
+def crop_mask(mask, origin, shape):
+    # Crop a mask with the given origin to the pixels inside an image of shape (pixels_y, pixels_x)
+    # Returns the cropped mask and its origin
+    start = np.maximum(origin, 0)
+    end = np.maximum(np.minimum(origin + (mask.shape[1], mask.shape[0]), (shape[1], shape[0])), start)
+    return mask[start[1] - origin[1]:end[1] - origin[1], start[0] - origin[0]:end[0] - origin[0]], start
+
+def dilate_points(points, radius, shape):
+    # Dilate integer (x, y) points to disks of the given radius in px, within an image of
+    # shape (pixels_y, pixels_x)
+    # Returns the dilated mask of the picks' bounding box and its origin
+    # Points more than radius px outside the image are dropped first, as their disks miss it and would
+    # stretch the bounding box the mask is allocated over
+    r = int(radius)
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    points = points[np.all((points >= -r) & (points < (shape[1] + r, shape[0] + r)), axis=1)]
+    mask, origin = rasterize_points(points, r)
+    if mask.size > 0:
+        mask = cv2.dilate(mask, dilation_kernel(radius))
+    return crop_mask(mask, origin, shape)
+
+def mask_coordinates(mask, origin):
+    # Return the (n, 2) array of (x, y) coordinates of the pixels set in a mask with the given origin
+    y, x = np.nonzero(mask)
+    return np.stack((x + origin[0], y + origin[1]), axis=1)
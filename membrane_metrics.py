@@ -0,0 +1,99 @@
+# Per-stage instrumentation of pick_membrane.py and repick_membrane.py. Each
+# micrograph collects its own Metrics of wall and CPU time per stage and event
+# counters, in whichever process refines it, and returns them with its results as
+# a plain dict. The main process writes one JSON line per micrograph and sums the
+# records into the run summary, so the summary stays exact across worker processes.
+
+
+# Imports
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import time
+
+
+class Metrics:
+    # Wall and CPU time in s per stage, and counters, of one micrograph
+    # CPU time is that of the calling thread, so stages loaded in a prefetch thread are not
+    # charged with the CPU time of refinement running concurrently
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        # Time the enclosed block, adding to any earlier time of the same stage
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.wall[name] = self.wall.get(name, 0.0) + time.perf_counter() - wall
+            self.cpu[name] = self.cpu.get(name, 0.0) + time.thread_time() - cpu
+
+    def count(self, name, n=1):
+        # Add n to a counter
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def record(self, **fields):
+        # Return the metrics as a flat dict of the given fields, then wall/{stage}, cpu/{stage} and
+        # count/{name} entries
+        record = dict(fields)
+        record.update((f"wall/{name}", t) for name, t in self.wall.items())
+        record.update((f"cpu/{name}", t) for name, t in self.cpu.items())
+        record.update((f"count/{name}", n) for name, n in self.counts.items())
+        return record
+
+
+class MetricsSummary:
+    # Totals of the metrics records of all micrographs of a run, optionally written to a JSON-lines
+    # file with one record per micrograph, and its summary beside it as {stem}_summary.json
+    # Stages of the run outside any one micrograph, such as pushing to cryosparc, are timed in run
+    def __init__(self, path=None, append=False):
+        self.path = None if path is None else Path(path)
+        self.totals = {}
+        self.micrographs = 0
+        self.run = Metrics()
+        self.file = None
+        if self.path is not None:
+            self.file = open(self.path, 'a' if append else 'w')
+
+    def add(self, record):
+        # Add one micrograph's record to the totals, and write it out
+        self.micrographs += 1
+        for name, value in record.items():
+            if name.startswith(("wall/", "cpu/", "count/")):
+                self.totals[name] = self.totals.get(name, 0) + value
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def summary(self):
+        # Return the totals of all micrographs and of the run, with the number of micrographs recorded
+        summary = {"micrographs": self.micrographs, **self.totals}
+        for name, value in self.run.record().items():
+            summary[name] = summary.get(name, 0) + value
+        return summary
+
+    def close(self):
+        # Close the records file and write the summary
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with open(self.path.with_name(f"{self.path.stem}_summary.json"), 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def report(self, file=None):
+        # Print the time of each stage and the counters
+        summary = self.summary()
+        print(f"Micrographs: {summary['micrographs']}", file=file)
+        for name in sorted(summary):
+            if name.startswith("wall/"):
+                stage = name[len("wall/"):]
+                print(f"Time in {stage}: {summary[name]:.2f}s wall, {summary.get('cpu/' + stage, 0):.2f}s CPU",
+                      file=file)
+        for name in sorted(summary):
+            if name.startswith("count/"):
+                print(f"{name[len('count/'):]}: {summary[name]}", file=file)
@@ -0,0 +1,252 @@
+# Execution helpers shared by pick_membrane.py, repick_membrane.py, dilate_picks.py
+# and respline_picks.py, for running the per-micrograph work either in the calling
+# process or across a pool of worker processes, and for writing its outputs.
+
+
+# Imports
+from membrane_refinement import blur_micrograph, BLUR_KERNEL_SIZE, BLUR_SIGMA
+from membrane_metrics import Metrics
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from pathlib import Path
+import numpy as np
+import queue
+import threading
+import sys
+import os
+
+
+def prefetch(load, tasks, depth=2):
+    # Yield load(*task) for each task in input order, loading ahead in a background thread so that
+    # I/O overlaps with the caller's processing of earlier results
+    # At most depth loaded results wait in the queue, to bound memory use. If depth is 0, load in the caller
+    if depth <= 0:
+        for task in tasks:
+            yield load(*task)
+        return
+    loaded = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # Wait for space in the queue, unless the consumer has stopped
+        while not stopped.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        for task in tasks:
+            try:
+                item = (load(*task), None)
+            except BaseException as e:
+                put((None, e))
+                return
+            if not put(item):
+                return
+        put((done, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = loaded.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        stopped.set()
+
+def download_micrograph(project, micrograph_path, cache=None):
+    # Return the image of a micrograph, from the local MicrographCache if given and the image is cached
+    # there, and otherwise downloaded from the cryosparc project and added to the cache
+    if cache is not None:
+        image = cache.get(micrograph_path)
+        if image is not None:
+            return image
+    header, image = project.download_mrc(micrograph_path)
+    image = image[0]
+    if cache is not None:
+        cache.put(micrograph_path, image)
+    return image
+
+def load_micrograph_images(project, micrograph_path, cache=None, cache_blurred=False, metrics=None):
+    # Return the image of a micrograph and its blurred image, using the local MicrographCache if given
+    # If cache_blurred, the fully blurred image is read from the cache without the image, which is
+    # returned as None, or computed and added to the cache on a miss
+    # Otherwise the blurred image is returned as None, to be computed from the image
+    # The time spent downloading or reading the cache, and blurring, is added to metrics if given
+    if metrics is None:
+        metrics = Metrics()
+    if cache is None or not cache_blurred:
+        with metrics.stage("download"):
+            return download_micrograph(project, micrograph_path, cache), None
+    blurred_key = f"{micrograph_path}?blur={BLUR_KERNEL_SIZE},{BLUR_SIGMA}"
+    with metrics.stage("download"):
+        image_blurred = cache.get(blurred_key)
+        if image_blurred is not None:
+            metrics.count("blurred_cache_hits")
+            return None, image_blurred
+        image = download_micrograph(project, micrograph_path, cache)
+    with metrics.stage("blur"):
+        image_blurred = blur_micrograph(image)
+        cache.put(blurred_key, image_blurred)
+    return image, image_blurred
+
+def load_and_process(load, process, task):
+    # Load the inputs of one task and process them, in the same process
+    return process(*task, load(*task))
+
+def map_micrographs(load, process, tasks, workers=1, max_in_flight=None, prefetch_depth=2,
+                    initializer=None, initargs=()):
+    # Apply process(*task, load(*task)) to each task, yielding results in input order
+    # With workers > 1, tasks run in a process pool where initializer(*initargs) first runs once
+    # in each worker process, and at most max_in_flight tasks (default twice the number of workers)
+    # are submitted but not yet yielded, to bound memory use
+    # With workers <= 1, tasks run in the calling process, which must already be initialized, and
+    # up to prefetch_depth tasks are loaded ahead in a background thread
+    if workers <= 1:
+        for task, loaded in zip(tasks, prefetch(load, tasks, prefetch_depth)):
+            yield process(*task, loaded)
+        return
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(executor.submit(load_and_process, load, process, task))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def save_atomic(path, save, *args, **kwargs):
+    # Write a file with save(f, *args, **kwargs) to a temporary file beside path, then move it into
+    # place, so that an interrupted run leaves either the complete file or none
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            save(f, *args, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+        raise
+
+class BackgroundWriter:
+    # Thread running save(*args, **kwargs) calls in submission order, so that encoding and writing
+    # files overlaps with the caller's processing of later micrographs
+    # At most depth calls wait in the queue, to bound memory use. Queued calls are finished by close,
+    # or when the main thread of the process exits, as in worker processes. Errors are reported and skipped
+    def __init__(self, depth=4):
+        self.queue = queue.Queue(maxsize=depth)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def submit(self, save, *args, **kwargs):
+        # Queue a call, waiting while the queue is full
+        self.queue.put((save, args, kwargs))
+
+    def run(self):
+        while True:
+            try:
+                save, args, kwargs = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed.is_set() or not threading.main_thread().is_alive():
+                    return
+                continue
+            try:
+                save(*args, **kwargs)
+            except Exception as e:
+                print(f"Failed to write {args[0] if args else save}: {e}", file=sys.stderr)
+
+    def close(self):
+        # Finish all queued calls
+        self.closed.set()
+        self.thread.join()
+
+def checkpoint_path(checkpoint_dir, uid):
+    # Return the checkpoint file of one micrograph
+    return Path(checkpoint_dir) / f"{uid}.npz"
+
+def save_checkpoint(checkpoint_dir, uid, pick_indices, pick_layers):
+    # Save the final (row, column) pick indices of one micrograph and the layer of each pick to the
+    # checkpoint directory
+    save_atomic(checkpoint_path(checkpoint_dir, uid), np.savez, rows=pick_indices[0], cols=pick_indices[1],
+                layers=pick_layers)
+
+def load_checkpoint(checkpoint_dir, uid):
+    # Return the pick indices and pick layers of one micrograph saved by save_checkpoint, or None if it
+    # has no checkpoint
+    try:
+        with np.load(checkpoint_path(checkpoint_dir, uid)) as checkpoint:
+            return (checkpoint["rows"], checkpoint["cols"]), checkpoint["layers"]
+    except FileNotFoundError:
+        return None
+
+def checkpointed_uids(checkpoint_dir):
+    # Return the set of uids of micrographs with checkpoints, with a single scan of the checkpoint directory
+    return {int(entry.name[:-len(".npz")]) for entry in os.scandir(checkpoint_dir)
+            if entry.name.endswith(".npz") and entry.name[:-len(".npz")].isdigit()}
+
+def add_pipeline_arguments(parser):
+    # Add the command line arguments controlling execution of the per-micrograph work
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes refining micrographs in parallel"
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=None,
+        help="Maximum number of micrographs submitted to workers but not yet collected. Default twice --workers"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of micrographs and their inputs to load ahead while refining with --workers 1. If 0, load on demand"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory of a local micrograph cache shared between runs, to skip downloading micrographs already fetched"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=100,
+        help="Maximum size in GB of the local micrograph cache, evicting least recently used micrographs first"
+    )
+    parser.add_argument(
+        "--cache_blurred",
+        action="store_true",
+        help="Also keep blurred micrographs in the local micrograph cache, to skip blurring on later runs"
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="Directory to save each micrograph's final picks to as soon as it is refined, from which all picks are assembled at the end"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip micrographs already saved in --checkpoint_dir by an earlier run with the same arguments"
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="JSON-lines file to write the time in each stage and the refinement counts of every micrograph to, with their totals written to {stem}_summary.json. Appended to with --resume"
+    )
@@ -0,0 +1,655 @@
+# Membrane refinement engine shared by pick_membrane.py, repick_membrane.py and
+# pick_membrane.ipynb. Refines vesicle contours in a micrograph to membrane
+# bilayer picks and fits splines through them, without any cryoSPARC or disk I/O.
+
+
+# Imports
+import numpy as np
+import cv2
+from scipy.signal import find_peaks
+from scipy.ndimage import correlate1d
+from scipy.interpolate import splprep, splev
+from dataclasses import dataclass, field
+from math import sqrt
+from membrane_metrics import Metrics
+import sys
+
+
+@dataclass
+class RefinementParameters:
+    # Parameters for refining the membranes of one micrograph
+    psize: float # Width of each pixel, in A
+    contour_spacing: float = 50 # Separation in A between sample points on vesicle contours
+    hist_offset: int = 90 # Distance in A for histogram to extend from the membrane
+    first_cutoff: float = 20.0 # Maximum deviation in A of picks from their neighbours in first cleaning step
+    second_cutoff: float = 50.0 # Maximum deviation in A of picks from their neighbours in second cleaning step
+    spline_density: int = 20000 # Number of points to pick from each spline fit to a vesicle
+    spline_spacing: float = None # Spacing in A between points sampled along each spline's arc length, instead of spline_density points. Spacings up to psize give every pixel the spline passes through
+    support_separation: float = 200 # Maximum distance in A between adjacent points in a spline's supporting arc. If -1, full spline returned
+    exact_profiles: bool = False # Bin every pixel in each segment's rectangle instead of sampling along segment normals
+    sort_contours: bool = False # Sort contour points by angle before downsampling, for contours not in clockwise order
+    roi_blur: bool = True # Only blur the regions around vesicle contours when they cover a small part of the micrograph
+    coarse_binning: int = None # If given, find each segment's approximate membrane offset on the micrograph binned by this factor, and only detect bilayers within fine_window of it. Not used with exact_profiles
+    fine_window: float = 40 # Distance in A either side of the approximate membrane offset to detect bilayers within
+
+
+@dataclass
+class MicrographRefinement:
+    # Result of refining the membranes of one micrograph
+    image_blurred: np.ndarray # Blurred micrograph the membrane profiles are sampled from, constant away from the vesicles with roi_blur
+    picks: list # Per vesicle, (n, 3, 2) array of inner membrane, intermembrane space, and outer membrane picks
+    picks_cleaned: list # Per vesicle, picks remaining after outlier cleaning
+    splines: list # Per fitted vesicle, (inner, intermembrane, outer) arrays of spline coordinates
+    spline_models: list # Per fitted vesicle, (inner, intermembrane, outer) splines' tck and supported parameter intervals
+    metrics: Metrics = field(default_factory=Metrics) # Time spent in each stage and counts of refinement outcomes
+
+
+# Gaussian kernel used to blur micrographs before sampling membrane intensity profiles
+BLUR_KERNEL_SIZE = 29
+BLUR_SIGMA = 5
+
+def merge_boxes(boxes):
+    # Merge overlapping (row_start, row_end, col_start, col_end) boxes into their bounding boxes
+    # until no two boxes overlap
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        merged_boxes = []
+        for box in boxes:
+            for i, other in enumerate(merged_boxes):
+                if box[0] < other[1] and other[0] < box[1] and box[2] < other[3] and other[2] < box[3]:
+                    merged_boxes[i] = (min(box[0], other[0]), max(box[1], other[1]),
+                                       min(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                merged_boxes.append(box)
+        boxes = merged_boxes
+    return boxes
+
+def contour_boxes(contours, padding, shape):
+    # Return the non-overlapping boxes covering the bounding boxes of all contours of (x, y) points,
+    # padded by padding pixels and clipped to an image of the given shape
+    boxes = []
+    for contour in contours:
+        contour = np.asarray(contour).reshape(-1, 2)
+        if len(contour) == 0:
+            continue
+        boxes.append((max(int(np.min(contour[:, 1])) - padding, 0), min(int(np.max(contour[:, 1])) + padding + 1, shape[0]),
+                      max(int(np.min(contour[:, 0])) - padding, 0), min(int(np.max(contour[:, 0])) + padding + 1, shape[1])))
+    return [box for box in merge_boxes(boxes) if box[0] < box[1] and box[2] < box[3]]
+
+def blur_micrograph(image, contours=None, padding=0, max_roi_fraction=0.5):
+    # Blur a micrograph before sampling membrane intensity profiles
+    # If contours are given and their padded bounding boxes cover at most max_roi_fraction of the image,
+    # only blur within those boxes, giving the same values there as blurring the whole image
+    # Pixels outside the boxes are set to the mean intensity of the image
+    if contours is None:
+        return cv2.GaussianBlur(image, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE), BLUR_SIGMA, BLUR_SIGMA)
+    boxes = contour_boxes(contours, padding, image.shape)
+    if sum((box[1] - box[0]) * (box[3] - box[2]) for box in boxes) > max_roi_fraction * image.size:
+        return cv2.GaussianBlur(image, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE), BLUR_SIGMA, BLUR_SIGMA)
+    image_blurred = np.full(image.shape, np.mean(image), dtype=image.dtype)
+    # Blur each box with a margin of the kernel radius, so that only pixels unaffected by the
+    # margin's border are kept
+    radius = BLUR_KERNEL_SIZE // 2
+    for row_start, row_end, col_start, col_end in boxes:
+        margin_row_start = max(row_start - radius, 0)
+        margin_col_start = max(col_start - radius, 0)
+        window = np.ascontiguousarray(image[margin_row_start:min(row_end + radius, image.shape[0]),
+                                            margin_col_start:min(col_end + radius, image.shape[1])])
+        window_blurred = cv2.GaussianBlur(window, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE), BLUR_SIGMA, BLUR_SIGMA)
+        image_blurred[row_start:row_end, col_start:col_end] = window_blurred[
+            row_start - margin_row_start:row_end - margin_row_start,
+            col_start - margin_col_start:col_end - margin_col_start]
+    return image_blurred
+
+def downsample_contour(particles, dist, psize, sort_by_angle=False):
+    # Select a sparse set of particles from a contour such that each particle
+    # is at least dist nm from its previous neighbor
+    # Precondition: particles are sorted by angle (clockwise or anticlockwise)
+    # unless sort_by_angle is set
+
+    # NOTE: If the particles were generated by some method which does not return
+    # them in clockwise order, sort them. However, it may cause poor
+    # ordering on vesicles with many folds
+    if sort_by_angle:
+        particles_angles = np.arctan2(particles[:, 1] - np.mean(particles[:, 1]),
+                                      particles[:, 0] - np.mean(particles[:, 0]))
+        particles = particles[np.argsort(particles_angles), :]
+
+    particles_downsampled = [particles[0]]
+    for particle in particles:
+        if np.linalg.norm(particle - particles_downsampled[-1]) * psize >= dist:
+            particles_downsampled.append(particle)
+    return particles_downsampled
+
+def pixels_in_rectangle(p1, p2):
+    # Find the pixels in the 4:1 rectangle centered around the two membrane points given.
+    # The rectangle is the union of four 1:1 squares shifted from the given points, each with upper
+    # corners p1, p2. All squares are tested at once over the rectangle's bounding box, using the
+    # same determinant test as a point-in-square check and each square's half-open bounding box.
+    # Returns an (n, 2) int array of pixel coordinates, in the same axis order as p1 and p2
+    p1 = np.asarray(p1, dtype=np.int64)
+    p2 = np.asarray(p2, dtype=np.int64)
+    # Calculate offset of one square
+    d1 = p1[0] - p2[0]
+    d2 = p1[1] - p2[1]
+    if d2 > 0:
+        s = np.array([d2, -d1])
+    else: # d2 <= 0
+        s = np.array([-d2, d1])
+    # Corners of each square in traversible order, shape (square, corner, axis)
+    shifts = np.arange(-2, 2)[:, None] * s
+    corners = np.stack((p1 + shifts, p2 + shifts, p2 + shifts + s, p1 + shifts + s), axis=1)
+    corners_min = corners.min(axis=1)[:, :, None, None]
+    corners_max = corners.max(axis=1)[:, :, None, None]
+    rows = np.arange(corners_min[:, 0].min(), corners_max[:, 0].max())
+    cols = np.arange(corners_min[:, 1].min(), corners_max[:, 1].max())
+    row, col = np.meshgrid(rows, cols, indexing="ij")
+    # Compute determinant of each edge to point transformation: positive if clockwise, negative otherwise
+    a = corners[:, :, :, None, None]
+    b = np.roll(corners, -1, axis=1)[:, :, :, None, None]
+    D = (b[:, :, 0] - a[:, :, 0]) * (col - a[:, :, 1]) - (b[:, :, 1] - a[:, :, 1]) * (row - a[:, :, 0])
+    # If the point is on different sides of both pairs of opposite lines, it is within the square
+    # Negative sign reverses orientation of opposite line, use not equal to permit points on one line (D=0)
+    D = np.sign(D)
+    in_square = (D[:, 0] != -D[:, 2]) & (D[:, 1] != -D[:, 3])
+    in_square &= (corners_min[:, 0] <= row) & (row < corners_max[:, 0])
+    in_square &= (corners_min[:, 1] <= col) & (col < corners_max[:, 1])
+    in_rectangle = in_square.any(axis=0)
+    return np.stack((row[in_rectangle], col[in_rectangle]), axis=1)
+
+def rectangle_profile(img, p1, p2, rectangle, psize, hist_offset):
+    # Compute the intensity profile of the rectangle as the mean intensity of its points binned
+    # by their distance in A from the line through p1 and p2, from -hist_offset to hist_offset
+    # Empty bins are given intensity 0.0
+    # Calculate vector pointing out of the vesicle, given points proceed clockwise
+    d1 = - (p2[1] - p1[1])
+    d2 = (p2[0] - p1[0])
+    # Keep points within the image
+    rectangle = rectangle[(0 <= rectangle[:, 1]) & (rectangle[:, 1] < img.shape[0]) &
+                          (0 <= rectangle[:, 0]) & (rectangle[:, 0] < img.shape[1])]
+    # Project all points at once, truncating distances towards zero as int() does
+    p_dist = ((((rectangle[:, 0] - p1[0]) * d1 + (rectangle[:, 1] - p1[1]) * d2)
+               / sqrt(d1 ** 2 + d2 ** 2)) * psize).astype(int)
+    in_hist = np.abs(p_dist) <= hist_offset
+    bins = p_dist[in_hist] + hist_offset
+    values = img[rectangle[in_hist, 1], rectangle[in_hist, 0]]
+    sums = np.bincount(bins, weights=values, minlength=2 * hist_offset + 1)
+    counts = np.bincount(bins, minlength=2 * hist_offset + 1)
+    intensities = np.zeros(2 * hist_offset + 1)
+    np.divide(sums, counts, out=intensities, where=counts > 0)
+    return intensities
+
+def collect_segments(masks_edges, contour_spacing, psize):
+    # Gather the pairs of adjacent sample points on every vesicle contour into arrays of segment
+    # start points, end points, and the index of the vesicle each segment belongs to
+    segment_starts = [np.empty((0, 2), dtype=int)]
+    segment_ends = [np.empty((0, 2), dtype=int)]
+    segment_vesicles = [np.empty(0, dtype=int)]
+    for i, edges in enumerate(masks_edges):
+        edges = np.asarray(edges).reshape(-1, 2)
+        # For runtime reasons, skip very far particle pairs
+        is_near = np.linalg.norm(edges[:-1] - edges[1:], axis=1) * psize <= contour_spacing * 1.5
+        segment_starts.append(edges[:-1][is_near])
+        segment_ends.append(edges[1:][is_near])
+        segment_vesicles.append(np.full(np.count_nonzero(is_near), i))
+    return np.concatenate(segment_starts), np.concatenate(segment_ends), np.concatenate(segment_vesicles)
+
+# Maximum width and height of the maps cv2.remap accepts (SHRT_MAX)
+REMAP_MAX_ROWS = 32767
+
+def segment_profiles(img, p1, p2, psize, hist_offset, max_samples=2 ** 20, centers=None):
+    # Compute the intensity profiles of all segments from p1[k] to p2[k] as one (n_segments, 2 * hist_offset + 1)
+    # matrix, by sampling the image along each segment's normal with bilinear interpolation (cv2.remap)
+    # Each row approximates rectangle_profile: bin j is sampled j A from the line through the segment, shifted
+    # half a bin away from the line to match its truncated distances, and averaged over one sample per pixel
+    # along the segment. Samples outside the image or the 4:1 rectangle are excluded, empty bins are 0.0
+    # If centers are given, row k only holds bins centers[k] - hist_offset to centers[k] + hist_offset, with the
+    # same values as those bins of a wider profile
+    # Segments are processed in chunks of at most max_samples samples to bound memory use, and of fewer than
+    # SHRT_MAX rows of samples, the largest map cv2.remap accepts
+    profiles = np.zeros((len(p1), 2 * hist_offset + 1))
+    if len(p1) == 0:
+        return profiles
+    img = np.asarray(img, dtype=np.float32)
+    p1 = np.asarray(p1, dtype=np.float32)
+    p2 = np.asarray(p2, dtype=np.float32)
+    # Calculate unit vectors along the segment and pointing out of the vesicle, given points proceed clockwise
+    lengths = np.linalg.norm(p2 - p1, axis=1)
+    tangents = (p2 - p1) / lengths[:, None]
+    normals = np.stack((-tangents[:, 1], tangents[:, 0]), axis=1)
+    # Distance in pixels of each segment's bins' samples from the segment
+    bins = np.arange(-hist_offset, hist_offset + 1)
+    if centers is None:
+        bins = np.broadcast_to(bins, (len(p1), len(bins)))
+    else:
+        bins = np.asarray(centers)[:, None] + bins
+    bin_dists = ((bins + 0.5 * np.sign(bins)) / psize).astype(np.float32)
+    n_bins = bin_dists.shape[1]
+    # One sample per pixel along each segment, padded to the longest segment
+    n_steps = np.maximum(np.ceil(lengths).astype(int), 1)
+    steps = np.arange(n_steps.max())
+    chunk_size = max(1, min(max_samples // (len(steps) * n_bins), (REMAP_MAX_ROWS - 1) // len(steps)))
+    for start in range(0, len(p1), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        chunk_dists = bin_dists[chunk, None, :]
+        # Sample positions with shape (segment * step along segment, bin)
+        along = ((steps + 0.5) / n_steps[chunk, None] * lengths[chunk, None]).astype(np.float32)[:, :, None]
+        x = p1[chunk, 0, None, None] + along * tangents[chunk, 0, None, None] + chunk_dists * normals[chunk, 0, None, None]
+        y = p1[chunk, 1, None, None] + along * tangents[chunk, 1, None, None] + chunk_dists * normals[chunk, 1, None, None]
+        # Move padding samples and samples beyond the rectangle outside the image, where remap returns nan
+        is_outside = ((steps >= n_steps[chunk, None])[:, :, None] |
+                      (np.abs(chunk_dists) > 2 * lengths[chunk, None, None]))
+        x[np.broadcast_to(is_outside, x.shape)] = -2
+        values = cv2.remap(img, x.reshape(-1, n_bins), y.reshape(-1, n_bins),
+                           cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=np.nan)
+        values = values.reshape(x.shape)
+        is_sampled = ~np.isnan(values)
+        sums = np.where(is_sampled, values, 0.0).sum(axis=1, dtype=np.float64)
+        counts = is_sampled.sum(axis=1)
+        np.divide(sums, counts, out=profiles[chunk], where=counts > 0)
+    return profiles
+
+def coarse_membrane_offsets(img, p1, p2, psize, hist_offset, binning, fine_window):
+    # Estimate the offset in A of the membrane bilayer center of each segment from p1[k] to p2[k], within
+    # hist_offset A, from profiles with bins of binning A sampled from the image binned by that factor
+    # The estimate is the best match to two leaflets 35 A apart, clipped so that the fine_window around it
+    # stays within hist_offset
+    img = np.asarray(img, dtype=np.float32)
+    binned = cv2.resize(img, (img.shape[1] // binning, img.shape[0] // binning), interpolation=cv2.INTER_AREA)
+    n_bins = hist_offset // binning
+    profiles = segment_profiles(binned, np.asarray(p1) / binning, np.asarray(p2) / binning, psize, n_bins)
+    # Zero mean template of two dark leaflets, blurred by at least one coarse bin
+    template_bins = np.arange(-int(np.ceil(40 / binning)), int(np.ceil(40 / binning)) + 1) * binning
+    width = max(binning, 6)
+    template = -(np.exp(-0.5 * ((template_bins - 17.5) / width) ** 2) + np.exp(-0.5 * ((template_bins + 17.5) / width) ** 2))
+    template -= template.mean()
+    match = correlate1d(profiles, template[::-1], axis=1, mode='nearest')
+    offsets = (np.argmax(match, axis=1) - n_bins) * binning
+    return np.clip(offsets, -(hist_offset - int(fine_window)), hist_offset - int(fine_window))
+
+NO_BILAYER = np.iinfo(np.int32).min
+
+def detect_bilayers(profiles, offset, metrics=None):
+    # Identify the membrane bilayer in each row of a matrix of intensity profiles as a pair of negative
+    # peaks with 25 to 45 A of separation surrounding a positive peak, with peaks found at a prominence
+    # of 0.1 times the range of the row. Returns an (n_profiles, 3) array of inner membrane, intermembrane
+    # space, and outer membrane offsets, with rows of NO_BILAYER where no bilayer is picked
+    # If multiple candidates are detected, the candidate with the lowest intensity is picked only if the
+    # second lowest exceeds it by more than 0.25 times the range of the row
+    # If metrics are given, counts the profiles with zero, one, and multiple candidates, and the multiple
+    # candidate profiles where no candidate dominates
+    profiles = np.asarray(profiles, dtype=float)
+    n_profiles, n_bins = profiles.shape
+    bilayers = np.full((n_profiles, 3), NO_BILAYER)
+    if n_profiles == 0:
+        return bilayers
+    intensities_range = np.max(profiles, axis=1) - np.min(profiles, axis=1)
+    # Find peaks of all rows in one call by joining rows with separators higher than any peak, which
+    # stop prominence calculations at row ends as the ends of a single profile would
+    # The window length only bounds the calculation for the separators themselves
+    stride = n_bins + 1
+    prominence = np.repeat(0.1 * intensities_range, stride)
+    signal = np.full((n_profiles, stride), np.inf)
+    signal[:, :n_bins] = profiles
+    pos_peaks = find_peaks(signal.ravel(), prominence=prominence, wlen=2 * stride + 1)[0]
+    signal[:, :n_bins] = -profiles
+    neg_peaks = find_peaks(signal.ravel(), prominence=prominence, wlen=2 * stride + 1)[0]
+    pos_peaks = pos_peaks[pos_peaks % stride != n_bins]
+    neg_peaks = neg_peaks[neg_peaks % stride != n_bins]
+    # Pair each positive peak with the closest negative peaks before and after it in the same row
+    after = np.searchsorted(neg_peaks, pos_peaks)
+    has_neighbours = (after > 0) & (after < len(neg_peaks))
+    pos_peaks = pos_peaks[has_neighbours]
+    neg_before = neg_peaks[after[has_neighbours] - 1]
+    neg_after = neg_peaks[after[has_neighbours]]
+    rows = pos_peaks // stride
+    is_candidate = ((neg_before // stride == rows) & (neg_after // stride == rows) &
+                    (25 <= neg_after - neg_before) & (neg_after - neg_before <= 45))
+    rows = rows[is_candidate]
+    candidates = np.stack((neg_before[is_candidate], pos_peaks[is_candidate], neg_after[is_candidate]), axis=1)
+    candidates = candidates - rows[:, None] * stride - offset
+    # Sort candidates by row, then by the intensity of their membrane positions
+    candidate_intensity = profiles[rows, candidates[:, 0] + offset] + profiles[rows, candidates[:, 2] + offset]
+    order = np.lexsort((candidate_intensity, rows))
+    rows = rows[order]
+    candidates = candidates[order]
+    candidate_intensity = candidate_intensity[order]
+    # Pick the first candidate of each row if it is alone or dominates the second
+    is_first = np.ones(len(rows), dtype=bool)
+    is_first[1:] = rows[1:] != rows[:-1]
+    first = np.flatnonzero(is_first)
+    has_second = np.zeros(len(first), dtype=bool)
+    has_second[:-1] = first[1:] - first[:-1] > 1
+    has_second[-1:] = len(rows) - first[-1:] > 1
+    is_picked = ~has_second
+    second = first[has_second] + 1
+    is_picked[has_second] = (candidate_intensity[second] - candidate_intensity[first[has_second]] >
+                             0.25 * intensities_range[rows[second]])
+    bilayers[rows[first[is_picked]]] = candidates[first[is_picked]]
+    if metrics is not None:
+        metrics.count("bilayers_zero", n_profiles - len(first))
+        metrics.count("bilayers_one", np.count_nonzero(~has_second))
+        metrics.count("bilayers_multiple", np.count_nonzero(has_second))
+        metrics.count("bilayers_ambiguous", np.count_nonzero(~is_picked))
+    return bilayers
+
+def update_picks(p1, p2, bilayers, psize):
+    # Generate updated membrane picks for all segments from p1[k] to p2[k] by shifting their midpoints by the
+    # distances in bilayers corresponding to inner membrane, intermembrane space, and outer membrane
+    # Returns an (n_segments, 3, 2) int array of picks
+    # Calculate midpoint from p1 to p2
+    midpoints = (np.asarray(p1) + np.asarray(p2)) / 2
+    # Calculate unit vector pointing out of the vesicle, given points proceed clockwise
+    d = np.stack((-(p2[:, 1] - p1[:, 1]), p2[:, 0] - p1[:, 0]), axis=1)
+    d = d / np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2)[:, None]
+    return np.round(midpoints[:, None, :] + bilayers[:, :, None] * d[:, None, :] / psize).astype(int)
+
+def group_by_vesicle(values, vesicles, n_vesicles):
+    # Split an array of per segment values into a list of arrays, one per vesicle, given the
+    # vesicle index of each segment in non-decreasing order as returned by collect_segments
+    return np.split(values, np.searchsorted(vesicles, np.arange(1, n_vesicles)))[:n_vesicles]
+
+def clean_edges(edges, cutoff, psize):
+    # Clean a proposed set of membrane positions by removing positions which are further than the given cutoff distance in A from the line between their neighbours
+    # Vesicles with fewer than 3 positions are emptied
+    updated_edges = []
+    for edge in edges:
+        edge = np.asarray(edge)
+        if len(edge) < 3:
+            updated_edges.append(np.empty((0, 3, 2), dtype=int))
+            continue
+        # Uses inner membrane (im), wrapping around the vesicle
+        im_edge = edge[:, 0]
+        im_edge = np.concatenate((im_edge, im_edge[:2]))
+        im_edge_vec1 = im_edge[1:-1] - im_edge[:-2] # Vector from neighbour to point
+        im_edge_vec2 = im_edge[2:] - im_edge[:-2] # Vector from neighbor to neighbour
+        # Distance of self from line between neighbours, as the projection onto the normal of that line
+        # Coincident neighbours give an infinite or undefined distance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            im_deviance = psize * ((im_edge_vec1[:, 0] * im_edge_vec2[:, 1] - im_edge_vec1[:, 1] * im_edge_vec2[:, 0])
+                                   / np.sqrt(im_edge_vec2[:, 1] ** 2 + im_edge_vec2[:, 0] ** 2))
+        # The deviance of each position is stored at the index of its previous neighbour. The first
+        # position is never removed
+        is_kept = np.ones(len(edge), dtype=bool)
+        is_kept[1:] = ~(np.abs(im_deviance[:-1]) > cutoff)
+        updated_edges.append(edge[is_kept])
+    return updated_edges
+
+def clean_picks(edges, first_cutoff, second_cutoff, psize, metrics=None):
+    # Clean the refined vesicle edge picks to remove outliers
+    # If metrics are given, counts the picks removed by each cleaning pass
+    edges_cleaned = clean_edges(edges, first_cutoff, psize)
+    if metrics is not None:
+        metrics.count("clean_removed_pass_1", sum(len(edge) for edge in edges) - sum(len(edge) for edge in edges_cleaned))
+    # Repeat with a second cutoff until all points fit, to catch remaining outliers
+    # The first repeat cleans every vesicle, as the second cutoff may be stricter than the first. After
+    # that, only the vesicles changed by the previous pass can change again
+    changed = range(len(edges))
+    if all(len(edges[i]) == len(edges_cleaned[i]) for i in changed):
+        changed = []
+    clean_pass = 2
+    while len(changed) > 0:
+        edges = edges_cleaned
+        edges_cleaned = list(edges)
+        for i, edge in zip(changed, clean_edges([edges[i] for i in changed], second_cutoff, psize)):
+            edges_cleaned[i] = edge
+        if metrics is not None:
+            metrics.count(f"clean_removed_pass_{clean_pass}",
+                          sum(len(edges[i]) - len(edges_cleaned[i]) for i in changed))
+        changed = [i for i in changed if len(edges[i]) != len(edges_cleaned[i])]
+        clean_pass += 1
+    return edges_cleaned
+
+def find_supports(edge, psize, support_separation):
+    # Determine regions with points (support) to include in a spline, as (start, end) index pairs
+    # of arcs whose adjacent outer membrane points are within support_separation A of each other
+    p_x = np.array([points[2][0] for points in edge] + [edge[0][2][0]])
+    p_y = np.array([points[2][1] for points in edge] + [edge[0][2][1]])
+    supports = []
+    curr_start = 0
+    curr_end = 0
+    for j in range(1, len(p_x)):
+        if psize * ((p_x[j] - p_x[curr_end]) ** 2 + (p_y[j] - p_y[curr_end]) ** 2) < (support_separation) ** 2:
+            curr_end = j
+        else:
+            if curr_start != curr_end:
+                supports.append((curr_start, curr_end))
+            curr_start = j
+            curr_end = j
+    if curr_start != curr_end:
+        supports.append((curr_start, curr_end))
+    return supports
+
+# Maximum number of points sampled along the arc length of one spline, bounding the memory of degenerate fits
+MAX_SPLINE_SAMPLES = 2 ** 20
+# Maximum ratio of a fitted spline's arc length to the perimeter of the picks it is fit through, beyond
+# which the fit is degenerate
+MAX_SPLINE_STRETCH = 4
+
+def spline_arc_length(tck, subdivisions=64):
+    # Approximate the arc length of a spline from splprep by a polyline through the spline, with the
+    # given number of points in each span between its knots
+    # Returns the parameters of the polyline points and the cumulative arc length in px at each
+    knots = np.unique(tck[0])
+    u_dense = np.interp(np.arange((len(knots) - 1) * subdivisions + 1) / subdivisions, np.arange(len(knots)), knots)
+    x, y = splev(u_dense, tck)
+    arc_length = np.concatenate(([0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    return u_dense, arc_length
+
+def sample_spline(tck, spline_density, spacing=None):
+    # Sample integer pixel coordinates along a spline from splprep
+    # If spacing is None, spline_density points evenly spaced in the spline parameter are sampled
+    # Otherwise points are sampled every spacing px along the arc length of the spline. Spacings up to
+    # 1 px give a connected trace of every pixel the spline passes through. At most MAX_SPLINE_SAMPLES
+    # points are sampled, widening the spacing of longer splines
+    # Returns the pixels in order along the spline without duplicates, and the spline
+    # parameter at which each pixel is first reached
+    if spacing is None:
+        u_sampled = np.linspace(0, 1.0, spline_density)
+    else:
+        # Sample at most every quarter pixel for a connected trace, so consecutive rounded points are at most
+        # one pixel apart and few pixels the spline only clips are missed
+        step = min(spacing, 0.25) if spacing <= 1 else spacing
+        u_dense, arc_length = spline_arc_length(tck)
+        step = max(step, arc_length[-1] / MAX_SPLINE_SAMPLES)
+        u_sampled = np.interp(np.arange(0, arc_length[-1], step), arc_length, u_dense)
+    spline = np.round(splev(u_sampled, tck)).astype(int).reshape(2, -1).T
+    # Drop repeated pixels, keeping the first visit of each. Runs of the same pixel are dropped first,
+    # in O(n), so only the much shorter array of runs is sorted to find revisited pixels
+    runs = np.flatnonzero(np.concatenate(([True], np.any(spline[1:] != spline[:-1], axis=1))))
+    _, first = np.unique(spline[runs], axis=0, return_index=True)
+    first = runs[np.sort(first)]
+    return spline[first], u_sampled[first]
+
+def rasterize_spline(tck, intervals, spline_density, spacing=None):
+    # Sample integer pixel coordinates along the arcs of a spline from splprep between the (start, end)
+    # parameter intervals, sampled as in sample_spline
+    # Returns the pixels of the arcs in order along the spline
+    spline, spline_u = sample_spline(tck, spline_density, spacing)
+    # The pixels are ordered by parameter, so each arc is a slice of them
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    arc_starts = np.searchsorted(spline_u, intervals[:, 0], side='left')
+    arc_ends = np.searchsorted(spline_u, intervals[:, 1], side='right')
+    return np.concatenate([np.empty((0, 2), dtype=int)] + [spline[start:end] for start, end in zip(arc_starts, arc_ends)])
+
+def fit_spline_models(edges, psize, support_separation):
+    # Fit splines through the inner membrane, intermembrane space, and outer membrane picks of each
+    # vesicle with more than 3 picks, supported on the arcs of picks found by find_supports, or on the
+    # full spline if support_separation is -1
+    # Vesicles with a degenerate fit, longer than MAX_SPLINE_STRETCH times the perimeter of its picks,
+    # are skipped
+    # Returns a list with the (inner, intermembrane, outer) models of each fitted vesicle, where each
+    # model is the tck of the spline from splprep and the (start, end) parameter intervals of its arcs
+    models = []
+    for edge in edges:
+        if len(edge) <= 3:
+            continue
+        edge = np.asarray(edge)
+        if support_separation != -1:
+            supports = np.array(find_supports(edge, psize, support_separation), dtype=int).reshape(-1, 2)
+        try:
+            vesicle_models = []
+            for i in range(3):
+                p_x = np.append(edge[:, i, 0], edge[0, i, 0])
+                p_y = np.append(edge[:, i, 1], edge[0, i, 1])
+                tck, u = splprep([p_x, p_y], k=3)
+                perimeter = np.hypot(np.diff(p_x), np.diff(p_y)).sum()
+                if spline_arc_length(tck)[1][-1] > MAX_SPLINE_STRETCH * perimeter:
+                    raise ValueError("spline is much longer than the picks it is fit through")
+                if support_separation != -1:
+                    # Each supported arc runs between the spline parameters of its first and last points
+                    intervals = u[supports]
+                else: # Include full spline
+                    intervals = np.array([[0.0, 1.0]])
+                vesicle_models.append((tck, intervals))
+        except ValueError as e:
+            # Skip the whole vesicle so its three layers stay together
+            print(f"Skipping spline generation for vesicle due to error: {e}", file=sys.stderr)
+            continue
+        models.append(tuple(vesicle_models))
+    return models
+
+def rasterize_models(models, spline_density, spacing=None):
+    # Rasterize the models of each vesicle from fit_spline_models, sampled as in sample_spline
+    # Returns a list of (inner, intermembrane, outer) arrays of spline coordinates, one per vesicle
+    return [tuple(rasterize_spline(tck, intervals, spline_density, spacing) for tck, intervals in vesicle_models)
+            for vesicle_models in models]
+
+def decimate_spline(tck, intervals, spacing):
+    # Sample integer pixel coordinates every spacing px along the arcs of a spline from splprep between
+    # the (start, end) parameter intervals, from the start of each arc
+    # Returns the pixels of the arcs in order along the spline
+    u_dense, arc_length = spline_arc_length(tck)
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    arc_starts = np.interp(intervals[:, 0], u_dense, arc_length)
+    arc_ends = np.interp(intervals[:, 1], u_dense, arc_length)
+    counts = np.floor((arc_ends - arc_starts) / spacing).astype(int) + 1
+    if counts.sum() == 0:
+        return np.empty((0, 2), dtype=int)
+    # Arc length of each sample, as the start of its arc plus a multiple of spacing
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    u_sampled = np.interp(np.repeat(arc_starts, counts) + steps * spacing, arc_length, u_dense)
+    return np.round(splev(u_sampled, tck)).astype(int).reshape(2, -1).T
+
+def decimate_models(models, spacing):
+    # Sample the models of each vesicle from fit_spline_models every spacing px along their arcs
+    # Returns a list of (inner, intermembrane, outer) arrays of spline coordinates, one per vesicle
+    return [tuple(decimate_spline(tck, intervals, spacing) for tck, intervals in vesicle_models)
+            for vesicle_models in models]
+
+def fit_splines(edges, psize, spline_density, support_separation, spline_spacing=None):
+    # Generate splines through the inner membrane, intermembrane space, and outer membrane picks of each
+    # vesicle with more than 3 picks, restricted to the supported arcs unless support_separation is -1
+    # Splines are sampled every spline_spacing A along their arc length if given, otherwise at
+    # spline_density points
+    # Returns a list of (inner, intermembrane, outer) arrays of spline coordinates in order along each
+    # spline, one per fitted vesicle
+    return rasterize_models(fit_spline_models(edges, psize, support_separation), spline_density,
+                            None if spline_spacing is None else spline_spacing / psize)
+
+def render_picks(image, edges, radius=4, downsample=1):
+    # Return a copy of the image with a (2 * radius + 1) square marker at the maximum intensity
+    # drawn over every pick, stamping all markers at once
+    # If downsample > 1, the image is first reduced by that factor with area averaging, and the picks and
+    # marker radius scaled to match, keeping markers at least 3 px wide
+    image_out = np.array(image, dtype=np.float32 if downsample > 1 else None)
+    points = np.concatenate([np.empty((0, 2), dtype=int)] + [np.asarray(edge).reshape(-1, 2) for edge in edges])
+    if downsample > 1:
+        image_out = cv2.resize(image_out, (image_out.shape[1] // downsample, image_out.shape[0] // downsample),
+                               interpolation=cv2.INTER_AREA)
+        points = points // downsample
+        radius = max(radius // downsample, 1)
+    image_out_max = np.max(image_out)
+    offsets = np.arange(-radius, radius + 1)
+    rows = (points[:, 1, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2).ravel()
+    cols = (points[:, 0, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1).ravel()
+    is_inside = (0 <= rows) & (rows < image_out.shape[0]) & (0 <= cols) & (cols < image_out.shape[1])
+    image_out[rows[is_inside], cols[is_inside]] = image_out_max
+    return image_out
+
+def refine_picks(image_blurred, contours, params, metrics):
+    # Refine downsampled vesicle contours in a blurred micrograph to membrane bilayer picks, recording the
+    # time spent and the segments considered and skipped in metrics
+    # Returns the per vesicle picks
+    # Profile every valid pair of adjacent sample points within the vesicle masks
+    segment_starts, segment_ends, segment_vesicles = collect_segments(contours, params.contour_spacing, params.psize)
+    segments_considered = sum(max(len(edges) - 1, 0) for edges in contours)
+    metrics.count("segments_considered", segments_considered)
+    metrics.count("segments_skipped", segments_considered - len(segment_starts))
+    # Optionally search for bilayers only around a coarse estimate of each segment's membrane offset
+    centers = None
+    window = params.hist_offset
+    if params.coarse_binning is not None and not params.exact_profiles and params.fine_window < params.hist_offset:
+        window = int(params.fine_window)
+        with metrics.stage("coarse_offsets"):
+            centers = coarse_membrane_offsets(image_blurred, segment_starts, segment_ends, params.psize,
+                                              params.hist_offset, params.coarse_binning, window)
+    with metrics.stage("segment_profiles"):
+        if params.exact_profiles:
+            profiles = np.zeros((len(segment_starts), 2 * params.hist_offset + 1))
+            for i in range(len(segment_starts)):
+                edge_rectangle = pixels_in_rectangle(segment_starts[i], segment_ends[i])
+                profiles[i] = rectangle_profile(image_blurred, segment_starts[i], segment_ends[i], edge_rectangle,
+                                                params.psize, params.hist_offset)
+        else:
+            profiles = segment_profiles(image_blurred, segment_starts, segment_ends, params.psize, window,
+                                        centers=centers)
+    # Update vesicle edges to detected membrane
+    with metrics.stage("detect_bilayers"):
+        bilayers = detect_bilayers(profiles, window, metrics)
+    if centers is not None:
+        is_found = bilayers[:, 0] != NO_BILAYER
+        bilayers[is_found] += centers[is_found, None]
+        # Count segments whose bilayer is found more than two coarse bins from the coarse estimate
+        metrics.count("coarse_fine_disagree",
+                      np.count_nonzero(np.abs(bilayers[is_found, 1] - centers[is_found]) > 2 * params.coarse_binning))
+    is_picked = bilayers[:, 0] != NO_BILAYER
+    picks = update_picks(segment_starts[is_picked], segment_ends[is_picked], bilayers[is_picked], params.psize)
+    return group_by_vesicle(picks, segment_vesicles[is_picked], len(contours))
+
+def refine_micrograph(image, contours, params, image_blurred=None, metrics=None):
+    # Refine the membranes of all vesicles in a micrograph
+    # image: full resolution micrograph, only used if image_blurred is not given
+    # contours: per vesicle, (n, 2) array of contour points in full resolution pixel coordinates,
+    # proceeding clockwise
+    # params: RefinementParameters
+    # image_blurred: the micrograph already blurred with blur_micrograph, if available
+    # metrics: Metrics to add the time and counts of each stage to, such as those of loading the micrograph
+    # Returns a MicrographRefinement
+    if metrics is None:
+        metrics = Metrics()
+    if image_blurred is None:
+        with metrics.stage("blur"):
+            if params.roi_blur:
+                # Pad contours to cover every sampled distance from the membrane, and the interpolation
+                padding = int(np.ceil((params.hist_offset + 1) / params.psize)) + 2
+                image_blurred = blur_micrograph(image, contours, padding)
+            else:
+                image_blurred = blur_micrograph(image)
+    # Downsample vesicle edges
+    with metrics.stage("downsample_contours"):
+        contours_downsampled = [downsample_contour(edges, params.contour_spacing, params.psize, params.sort_contours)
+                                for edges in contours]
+    metrics.count("vesicles", len(contours))
+    picks = refine_picks(image_blurred, contours_downsampled, params, metrics)
+    metrics.count("picks", sum(len(edge) for edge in picks))
+    with metrics.stage("clean_picks"):
+        picks_cleaned = clean_picks(picks, params.first_cutoff, params.second_cutoff, params.psize, metrics)
+    with metrics.stage("fit_splines"):
+        spline_models = fit_spline_models(picks_cleaned, params.psize, params.support_separation)
+        splines = rasterize_models(spline_models, params.spline_density,
+                                   None if params.spline_spacing is None else params.spline_spacing / params.psize)
+    metrics.count("splines", sum(len(vesicle_splines) for vesicle_splines in splines))
+    metrics.count("spline_points", sum(len(spline) for vesicle_splines in splines for spline in vesicle_splines))
+    return MicrographRefinement(
+        image_blurred=image_blurred,
+        picks=picks,
+        picks_cleaned=picks_cleaned,
+        splines=splines,
+        spline_models=spline_models,
+        metrics=metrics
+    )
@@ -0,0 +1,67 @@
+# Local cache of micrograph arrays shared between runs of pick_membrane.py and
+# repick_membrane.py. Arrays are stored as float32 .npy files named by a hash of
+# their key, and read back memory-mapped so that cache hits need no download,
+# no decoding, and no copy.
+
+
+# Imports
+import numpy as np
+from pathlib import Path
+import hashlib
+import os
+
+
+class MicrographCache:
+    # Directory of cached arrays with a size cap, evicting least recently used arrays first
+    # Safe to share between processes: files are written atomically, and arrays already
+    # memory-mapped stay readable if their file is evicted
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        # Return the file caching the array with the given key
+        return self.cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.npy"
+
+    def get(self, key):
+        # Return the cached array for key as a read-only memory map, or None if it is not cached
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            # Mark as recently used for eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return array
+
+    def put(self, key, array):
+        # Cache a copy of array as float32 under key, then evict old arrays over the size cap
+        path = self.path(key)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array, dtype=np.float32))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        # Delete least recently used arrays until the cache fits within max_bytes
+        if self.max_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,78 @@
+# Export of membrane picks to cryoSPARC, shared by pick_membrane.py and
+# repick_membrane.py. Picks are exported either as every pixel of the final
+# splines, or decimated to a fixed spacing along each supported arc, and either
+# as one particle output or as one output per membrane layer.
+
+
+# Imports
+from vesicle_picker import external_export
+from cryosparc.tools import Dataset
+from pick_store import LAYERS
+import numpy as np
+
+
+def add_export_arguments(parser):
+    # Add the command line arguments controlling the picks exported to cryoSPARC
+    parser.add_argument(
+        "--pick_spacing",
+        type=float,
+        default=None,
+        help="Spacing in A between picks exported to cryoSPARC along each supported arc of the splines. If not given, every spline pixel is exported"
+    )
+    parser.add_argument(
+        "--split_layers",
+        action="store_true",
+        help="Export the picks of each layer (inner, intermembrane, outer) as a separate cryoSPARC output"
+    )
+
+def export_picks(splines):
+    # Return the (row, column) pick indices of every spline of one micrograph, and the index in
+    # LAYERS of the layer of each pick
+    splines = [(layer, spline) for vesicle_splines in splines for layer, spline in enumerate(vesicle_splines)]
+    picks = np.concatenate([np.empty((0, 2), dtype=int)] + [spline for layer, spline in splines])
+    pick_layers = np.concatenate([np.empty(0, dtype=np.uint8)] +
+                                 [np.full(len(spline), layer, dtype=np.uint8) for layer, spline in splines])
+    return (picks[:, 1], picks[:, 0]), pick_layers
+
+def output_names(split_layers):
+    # Return the names of the cryoSPARC particle outputs
+    if split_layers:
+        return [f"vesicle_picks_{layer}" for layer in LAYERS]
+    return ["vesicle_picks"]
+
+def construct_pick_datasets(micrograph, pick_indices, pick_layers, split_layers):
+    # Construct the Datasets of one micrograph's picks, as a dict from output name to Dataset
+    if not split_layers:
+        return {"vesicle_picks": external_export.construct_csparc_dataset(micrograph, pick_indices)}
+    return {name: external_export.construct_csparc_dataset(micrograph, (pick_indices[0][pick_layers == l],
+                                                                        pick_indices[1][pick_layers == l]))
+            for l, name in enumerate(output_names(split_layers))}
+
+def empty_pick_dataset():
+    # Return an empty Dataset with the fields of exported picks
+    vesicle_picks = Dataset()
+    vesicle_picks.add_fields(
+        ['location/micrograph_uid',
+         'location/exp_group_id',
+         'location/micrograph_path',
+         'location/micrograph_shape',
+         'location/center_x_frac',
+         'location/center_y_frac',
+         'location/micrograph_psize_A'],
+        ["<u8", "<u4", "str", "<u4", "<f4", "<f4", "<f4"])
+    return vesicle_picks
+
+def push_picks(project, workspace_uid, vesicle_picks):
+    # Push a dict from output name to Dataset of picks to a new external job in the workspace, as
+    # particle outputs
+    job = project.create_external_job(workspace_uid, title="Vesicle Picks")
+
+    # Tell the job what kind of outputs to expect
+    for name in vesicle_picks:
+        job.add_output("particle", name, slots=["location"])
+
+    # Start the job, push the outputs to cryosparc, stop the job
+    job.start()
+    for name, dataset in vesicle_picks.items():
+        job.save_output(name, dataset)
+    job.stop()
@@ -0,0 +1,321 @@
+# Command line, per-micrograph work and run loop shared by pick_membrane.py and
+# repick_membrane.py, which differ only in where they read vesicle contours from.
+# Each script supplies a load_micrograph(uid, micrograph_path, sources) returning
+# the image, blurred image, contours and Metrics of one micrograph, and optionally
+# a find_inputs(args, micrographs) choosing the micrographs to refine and the
+# sources of their contours.
+
+
+# Imports
+from vesicle_picker import helpers
+from cryosparc.tools import Dataset
+from membrane_refinement import RefinementParameters, refine_micrograph, render_picks, decimate_models
+from membrane_pipeline import (
+    map_micrographs,
+    BackgroundWriter,
+    add_pipeline_arguments,
+    save_checkpoint,
+    load_checkpoint,
+    checkpointed_uids
+)
+from micrograph_cache import MicrographCache
+from membrane_metrics import MetricsSummary
+from pick_store import save_pick_files, save_pick_store, save_spline_models
+from pick_export import (
+    add_export_arguments,
+    export_picks,
+    output_names,
+    construct_pick_datasets,
+    empty_pick_dataset,
+    push_picks
+)
+from local_cryosparc import add_local_arguments, check_local_arguments, open_project, load_micrographs
+from tqdm import tqdm
+from argparse import ArgumentParser
+import matplotlib.pyplot as plt
+from pathlib import Path
+
+
+def picking_parser(prog, description, hist_endpoints):
+    # Return a parser of the command line arguments shared by pick_membrane.py and repick_membrane.py,
+    # with the default distance in A for the histogram to extend from the membrane
+    parser = ArgumentParser(
+        prog=prog,
+        description=description
+    )
+    parser.add_argument(
+        "parameters", 
+        type=str,
+        help="Path to .ini file containing parameters for vesicle picking"
+    )
+    parser.add_argument(
+        "--contour_spacing",
+        type=float,
+        default=50,
+        help="Separation in A between sample points on vesicle contours"
+    )
+    parser.add_argument(
+        "--hist_endpoints",
+        type=int,
+        default=hist_endpoints,
+        help="Distance in A for histogram to extend from the membrane"
+    )
+    parser.add_argument(
+        "--exact_profiles",
+        action="store_true",
+        help="Bin every pixel in each segment's rectangle instead of sampling along segment normals (slower)"
+    )
+    parser.add_argument(
+        "--coarse_binning",
+        type=int,
+        default=None,
+        help="Find each segment's approximate membrane offset on the micrograph binned by this factor, then detect bilayers at full resolution only within --fine_window of it. Not used with --exact_profiles"
+    )
+    parser.add_argument(
+        "--fine_window",
+        type=float,
+        default=40,
+        help="Distance in A either side of the approximate membrane offset to detect bilayers within, with --coarse_binning"
+    )
+    parser.add_argument(
+        "--full_blur",
+        action="store_true",
+        help="Blur whole micrographs, instead of only the regions around vesicles when they cover a small part of the micrograph. Implied by --picks_dir and --cleaned_picks_dir"
+    )
+    parser.add_argument(
+        "--first_clean_cutoff",
+        type=float,
+        default=20.0,
+        help="Maximum distance in A to permit picks to deviate from their neighbours in first cleaning step"
+    )
+    parser.add_argument(
+        "--second_clean_cutoff",
+        type=float,
+        default=50.0,
+        help="Maximum distance in A to permit picks to deviate from their neighbours in second cleaning step"
+    )
+    parser.add_argument(
+        "--spline_density",
+        type=int,
+        default=20000,
+        help="Number of points to pick from each spline fit to a vesicle"
+    )
+    parser.add_argument(
+        "--spline_spacing",
+        type=float,
+        default=None,
+        help="Spacing in A between points picked along each spline's arc length, instead of --spline_density points. Spacings up to the pixel size pick every pixel the spline passes through"
+    )
+    parser.add_argument(
+        "--picks_dir",
+        type=str,
+        default=None,
+        help="Path to save image of initial membrane picks"
+    )
+    parser.add_argument(
+        "--cleaned_picks_dir",
+        type=str,
+        default=None,
+        help="Path to save image of only cleaned membrane picks"
+    )
+    parser.add_argument(
+        "--preview_downsample",
+        type=int,
+        default=1,
+        help="Factor to downsample the images of membrane picks by"
+    )
+    parser.add_argument(
+        "--support_separation",
+        type=float,
+        default=200,
+        help="Maximum distance in A between adjacent points in a spline's supporting arc. If -1, full spline returned"
+    )
+    parser.add_argument(
+        "--spline_dir",
+        type=str,
+        default=None,
+        help="Path to save np array of final membrane spline coordinates"
+    )
+    parser.add_argument(
+        "--spline_format",
+        type=str,
+        choices=["files", "store", "models"],
+        default="files",
+        help="Save final spline coordinates as one npy file per vesicle layer, or as one store per micrograph of the concatenated coordinates and their offsets, or save each micrograph's spline knots, coefficients and supported parameter intervals to rasterize when read"
+    )
+    add_export_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_local_arguments(parser)
+    return parser
+
+def parse_picking_args(parser):
+    # Parse command line arguments with a parser from picking_parser
+    args = parser.parse_args()
+    check_local_arguments(parser, args)
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume requires --checkpoint_dir")
+    return args
+
+# Per process state for refining micrographs, set by init_worker
+worker_state = {}
+
+def init_worker(args, sort_contours):
+    # Load parameters and connect to cryosparc once in each process refining micrographs
+    parameters = helpers.read_config(args.parameters)
+    worker_state["args"] = args
+    worker_state["parameters"] = parameters
+    # Load in commonly used parameters
+    worker_state["downsample"] = int(parameters.get('general', 'downsample'))
+    worker_state["refinement_parameters"] = RefinementParameters(
+        psize=float(parameters.get('general', 'psize')),
+        contour_spacing=args.contour_spacing,
+        hist_offset=args.hist_endpoints,
+        first_cutoff=args.first_clean_cutoff,
+        second_cutoff=args.second_clean_cutoff,
+        spline_density=args.spline_density,
+        spline_spacing=args.spline_spacing,
+        support_separation=args.support_separation,
+        exact_profiles=args.exact_profiles,
+        coarse_binning=args.coarse_binning,
+        fine_window=args.fine_window,
+        # Pick images show the blurred micrograph, so it is blurred whole when they are saved
+        roi_blur=not (args.full_blur or args.picks_dir is not None or args.cleaned_picks_dir is not None),
+        sort_contours=sort_contours
+    )
+    # Initialize a cryosparc session and open a project, or their local stand-in
+    worker_state["cs"], worker_state["project"] = open_project(args, parameters)
+    # Open the local micrograph cache
+    worker_state["cache"] = None
+    if args.cache_dir is not None:
+        worker_state["cache"] = MicrographCache(args.cache_dir, int(args.cache_size * 1e9))
+    # Write pick images in the background, while the next micrograph is refined
+    worker_state["image_writer"] = None
+    if args.picks_dir is not None or args.cleaned_picks_dir is not None:
+        worker_state["image_writer"] = BackgroundWriter()
+
+def process_micrograph(uid, micrograph_path, sources, loaded):
+    # Refine the membranes of one loaded micrograph and save its per-micrograph outputs
+    # Returns the final pick indices, pick layers, and metrics record, or None if the micrograph has no inputs
+    if loaded is None:
+        return None
+    image_fullres, image_blurred, masks_edges, metrics = loaded
+    args = worker_state["args"]
+
+    # Refine vesicle edges to the detected membrane, clean them, and fit splines
+    result = refine_micrograph(image_fullres, masks_edges, worker_state["refinement_parameters"], image_blurred,
+                               metrics)
+
+    with metrics.stage("save_images"):
+        # Save particle pick images
+        if args.picks_dir is not None:
+            image_out = render_picks(result.image_blurred, result.picks, downsample=args.preview_downsample)
+            worker_state["image_writer"].submit(plt.imsave, Path(args.picks_dir) / f"{uid}.png", image_out, cmap="gray")
+
+        # Save cleaned particle pick images
+        if args.cleaned_picks_dir is not None:
+            image_out = render_picks(result.image_blurred, result.picks_cleaned, downsample=args.preview_downsample)
+            worker_state["image_writer"].submit(plt.imsave, Path(args.cleaned_picks_dir) / f"{uid}_cleaned.png",
+                                                image_out, cmap="gray")
+
+    # Save final pick locations as arrays
+    if args.spline_dir is not None:
+        with metrics.stage("save_splines"):
+            if args.spline_format == "store":
+                save_pick_store(args.spline_dir, uid, result.splines)
+            elif args.spline_format == "models":
+                save_spline_models(args.spline_dir, uid, result.spline_models)
+            else:
+                save_pick_files(args.spline_dir, uid, result.splines)
+
+    # Record final pick indices, as (row, column) arrays of every spline's coordinates, and the
+    # layer of each pick, decimated along the supported arcs if requested
+    with metrics.stage("export_picks"):
+        splines = result.splines
+        if args.pick_spacing is not None:
+            splines = decimate_models(result.spline_models,
+                                      args.pick_spacing / worker_state["refinement_parameters"].psize)
+        pick_indices, pick_layers = export_picks(splines)
+    metrics.count("exported_picks", len(pick_layers))
+    return pick_indices, pick_layers, metrics.record(uid=int(uid))
+
+def all_micrographs(args, micrographs):
+    # Return each micrograph with no contour sources, for a load_micrograph finding its own inputs
+    return [(micrograph, None) for micrograph in micrographs]
+
+def run_picking(args, load_micrograph, sort_contours, find_inputs=all_micrographs):
+    # Refine the membranes of all micrographs, with contours read by load_micrograph and sorted by angle
+    # before downsampling if sort_contours, and push the picks to cryosparc or save them locally
+    init_worker(args, sort_contours)
+    parameters = worker_state["parameters"]
+
+    # Pull in the micrographs
+    micrographs = load_micrographs(args, parameters, worker_state["cs"])
+
+    # Picks of each micrograph for each output, concatenated into the final Datasets once all are collected
+    pick_datasets = {name: [] for name in output_names(args.split_layers)}
+
+    # Per micrograph metrics, written out as each micrograph is collected and summed for the run
+    metrics = MetricsSummary(args.metrics_file, append=args.resume)
+
+    # Skip micrographs checkpointed by an earlier run when resuming
+    completed = set()
+    if args.checkpoint_dir is not None:
+        Path(args.checkpoint_dir).mkdir(parents=True, exist_ok=True)
+        if args.resume:
+            completed = checkpointed_uids(args.checkpoint_dir)
+
+    # Find the inputs of each micrograph not yet refined, skipping micrographs without any
+    micrographs_to_refine = []
+    tasks = []
+    for micrograph, sources in find_inputs(args, [micrograph for micrograph in micrographs
+                                                  if int(micrograph['uid']) not in completed]):
+        micrographs_to_refine.append(micrograph)
+        tasks.append((micrograph['uid'], micrograph["micrograph_blob/path"], sources))
+
+    # Refine all micrographs, collecting results in input order, and the uids of those checkpointed by this run
+    checkpointed = set()
+    results = map_micrographs(load_micrograph, process_micrograph, tasks, args.workers, args.max_in_flight,
+                              args.prefetch, initializer=init_worker, initargs=(args, sort_contours))
+    for micrograph, result in tqdm(zip(micrographs_to_refine, results), total=len(tasks)):
+        # Skip micrographs without inputs
+        if result is None:
+            continue
+        pick_indices, pick_layers, micrograph_metrics = result
+        metrics.add(micrograph_metrics)
+        if args.checkpoint_dir is not None:
+            # Persist the picks as soon as each micrograph is refined, to assemble at the end
+            with metrics.run.stage("save_checkpoints"):
+                save_checkpoint(args.checkpoint_dir, micrograph['uid'], pick_indices, pick_layers)
+            checkpointed.add(int(micrograph['uid']))
+            continue
+        for name, dataset in construct_pick_datasets(micrograph, pick_indices, pick_layers, args.split_layers).items():
+            pick_datasets[name].append(dataset)
+
+    with metrics.run.stage("assemble_picks"):
+        # Assemble the picks from the checkpoints of the micrographs refined by this run, and by the earlier
+        # runs it resumes, ignoring any other checkpoints left in the directory
+        if args.checkpoint_dir is not None:
+            assembled = completed | checkpointed
+            for micrograph in micrographs:
+                if int(micrograph['uid']) not in assembled:
+                    continue
+                checkpoint = load_checkpoint(args.checkpoint_dir, micrograph['uid'])
+                if checkpoint is not None:
+                    for name, dataset in construct_pick_datasets(micrograph, *checkpoint, args.split_layers).items():
+                        pick_datasets[name].append(dataset)
+
+        # Concatenate all picks in a single pass, instead of copying the growing Dataset for each micrograph
+        vesicle_picks = {name: Dataset.append_many(empty_pick_dataset(), *datasets)
+                         for name, datasets in pick_datasets.items()}
+
+    # Push vesicle_picks to cryosparc, or save them locally
+    with metrics.run.stage("push"):
+        push_picks(worker_state["project"], parameters.get('csparc_input', 'WID', fallback=None), vesicle_picks)
+
+    # Finish writing pick images in this process, while worker processes finish theirs as they exit
+    if worker_state["image_writer"] is not None:
+        worker_state["image_writer"].close()
+
+    metrics.close()
+    metrics.report()
+
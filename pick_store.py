@@ -0,0 +1,174 @@
+# Reading and writing of the spline coordinates saved by pick_membrane.py and
+# repick_membrane.py, and read by repick_membrane.py, dilate_picks.py and
+# respline_picks.py. Splines are saved either as one .npy file per vesicle layer,
+# {uid}_vesicle_{index}_{layer}.npy, or as one store per micrograph of two .npy
+# files: {uid}_splines.npy, the int32 (n, 2) coordinates of all vesicle layers
+# concatenated, and {uid}_splines_offsets.npy, where layer l of vesicle v is rows
+# offsets[v, l] to offsets[v, l + 1] of the coordinates. Stores are read memory-mapped.
+# Splines can also be saved as their models, {uid}_spline_models.npz, holding the
+# knots, coefficients, and supported parameter intervals of every vesicle layer
+# concatenated with offsets in the same way, and rasterized when read.
+
+
+# Imports
+from membrane_pipeline import save_atomic
+from membrane_refinement import rasterize_spline
+import numpy as np
+from pathlib import Path
+from functools import lru_cache
+import re
+import sys
+import os
+
+
+# Layers of each vesicle's splines, in the order they are fitted and stored
+LAYERS = ("inner", "intermembrane", "outer")
+
+# Names of per vesicle layer files, where derived arrays extend the layer name (as inner_dilated),
+# and of micrograph stores
+PICK_FILENAME = re.compile(r"(\d+)_vesicle_(\d+)_(.+)\.npy")
+STORE_FILENAME = re.compile(r"(\d+)_splines\.npy")
+MODELS_FILENAME = re.compile(r"(\d+)_spline_models\.npz")
+
+
+def save_pick_files(directory, uid, splines):
+    # Save each layer of each vesicle's splines of one micrograph to its own .npy file
+    directory = Path(directory)
+    for i, vesicle_splines in enumerate(splines):
+        for layer, spline in zip(LAYERS, vesicle_splines):
+            save_atomic(directory / f"{uid}_vesicle_{i}_{layer}.npy", np.save, spline)
+
+def store_paths(directory, uid):
+    # Return the coordinates and offsets files of the store of one micrograph
+    directory = Path(directory)
+    return directory / f"{uid}_splines.npy", directory / f"{uid}_splines_offsets.npy"
+
+def layer_offsets(arrays):
+    # Return the (vesicles, layers + 1) offsets of each vesicle layer's rows in the concatenation of
+    # arrays, given in vesicle then layer order
+    ends = np.cumsum([len(array) for array in arrays], dtype=np.int64)
+    starts = np.concatenate(([0], ends))
+    return np.column_stack((starts[:-1].reshape(-1, len(LAYERS)), starts[len(LAYERS)::len(LAYERS)]))
+
+def save_pick_store(directory, uid, splines):
+    # Save the splines of one micrograph to its store, writing the offsets last so that a store
+    # with offsets is complete
+    coordinates_path, offsets_path = store_paths(directory, uid)
+    coordinates = [np.asarray(spline, dtype=np.int32).reshape(-1, 2)
+                   for vesicle_splines in splines for spline in vesicle_splines]
+    offsets = layer_offsets(coordinates)
+    coordinates = np.concatenate([np.empty((0, 2), dtype=np.int32)] + coordinates)
+    save_atomic(coordinates_path, np.save, coordinates)
+    save_atomic(offsets_path, np.save, offsets)
+
+def models_path(directory, uid):
+    # Return the file of the spline models of one micrograph
+    return Path(directory) / f"{uid}_spline_models.npz"
+
+def save_spline_models(directory, uid, models):
+    # Save the spline models of one micrograph from fit_spline_models
+    models = [model for vesicle_models in models for model in vesicle_models]
+    knots = [tck[0] for tck, intervals in models]
+    coefficients = [np.stack(tck[1], axis=1) for tck, intervals in models]
+    intervals = [np.asarray(intervals, dtype=float).reshape(-1, 2) for tck, intervals in models]
+    save_atomic(models_path(directory, uid), np.savez,
+                knots=np.concatenate([np.empty(0)] + knots),
+                knot_offsets=layer_offsets(knots),
+                coefficients=np.concatenate([np.empty((0, 2))] + coefficients),
+                coefficient_offsets=layer_offsets(coefficients),
+                intervals=np.concatenate([np.empty((0, 2))] + intervals),
+                interval_offsets=layer_offsets(intervals),
+                degree=np.array([models[0][0][2] if models else 3]))
+
+@lru_cache(maxsize=1)
+def load_spline_models(path):
+    # Return the spline models of a micrograph, as from fit_spline_models, cached for the layers of the
+    # micrograph being read
+    with np.load(path) as archive:
+        models = {name: archive[name] for name in archive.files}
+    degree = int(models["degree"][0])
+    vesicles = []
+    for knot_offsets, coefficient_offsets, interval_offsets in zip(models["knot_offsets"], models["coefficient_offsets"],
+                                                                  models["interval_offsets"]):
+        vesicle_models = []
+        for l in range(len(LAYERS)):
+            coefficients = models["coefficients"][coefficient_offsets[l]:coefficient_offsets[l + 1]]
+            tck = (models["knots"][knot_offsets[l]:knot_offsets[l + 1]], [coefficients[:, 0], coefficients[:, 1]], degree)
+            vesicle_models.append((tck, models["intervals"][interval_offsets[l]:interval_offsets[l + 1]]))
+        vesicles.append(tuple(vesicle_models))
+    return vesicles
+
+def load_pick_store(coordinates_path):
+    # Return the splines of a micrograph store, given its coordinates file, as a list with the
+    # (inner, intermembrane, outer) views of each vesicle into the memory-mapped coordinates
+    coordinates_path = Path(coordinates_path)
+    offsets = np.load(coordinates_path.with_name(coordinates_path.stem + "_offsets.npy"))
+    coordinates = np.load(coordinates_path, mmap_mode='r')
+    return [tuple(coordinates[start:end] for start, end in zip(vesicle_offsets[:-1], vesicle_offsets[1:]))
+            for vesicle_offsets in offsets]
+
+def index_pick_files(directory):
+    # Index the splines saved in a directory with a single scan, as per vesicle layer files, stores,
+    # or models
+    # Returns a dict from micrograph uid to a dict from vesicle index to a dict from layer name to
+    # the spline's source for load_pick_array. Other .npy files and incomplete stores are reported
+    # and skipped
+    index = {}
+    names = {entry.name: entry.path for entry in os.scandir(directory)
+             if entry.name.endswith((".npy", ".npz")) and entry.is_file()}
+    for name, path in names.items():
+        match = PICK_FILENAME.fullmatch(name)
+        if match is not None:
+            uid, vesicle, layer = match.groups()
+            index.setdefault(int(uid), {}).setdefault(int(vesicle), {})[layer] = path
+            continue
+        match = STORE_FILENAME.fullmatch(name)
+        if match is not None:
+            uid = match.group(1)
+            if f"{uid}_splines_offsets.npy" not in names:
+                print(f"Skipping {name}, store has no offsets", file=sys.stderr)
+                continue
+            # Stores are indexed by their offsets, and their coordinates only read when loaded
+            offsets = np.load(names[f"{uid}_splines_offsets.npy"])
+            vesicles = index.setdefault(int(uid), {})
+            for vesicle, vesicle_offsets in enumerate(offsets):
+                for layer, start, end in zip(LAYERS, vesicle_offsets[:-1], vesicle_offsets[1:]):
+                    vesicles.setdefault(vesicle, {})[layer] = ("store", path, int(start), int(end))
+            continue
+        match = MODELS_FILENAME.fullmatch(name)
+        if match is not None:
+            with np.load(path) as archive:
+                n_vesicles = len(archive["knot_offsets"])
+            vesicles = index.setdefault(int(match.group(1)), {})
+            for vesicle in range(n_vesicles):
+                for l, layer in enumerate(LAYERS):
+                    vesicles.setdefault(vesicle, {})[layer] = ("models", path, vesicle, l)
+            continue
+        if name.endswith(".npy") and not name.endswith("_splines_offsets.npy"):
+            print(f"Skipping {name}, not named as {{uid}}_vesicle_{{index}}_{{layer}}.npy or {{uid}}_splines.npy", file=sys.stderr)
+    return index
+
+def load_spline_model(source):
+    # Return the tck and supported parameter intervals of one spline indexed by index_pick_files, or
+    # None if it was saved as coordinates
+    if isinstance(source, tuple) and source[0] == "models":
+        kind, path, vesicle, layer = source
+        return load_spline_models(path)[vesicle][layer]
+    return None
+
+def load_pick_array(source, spline_density=None, spacing=1, shape=None):
+    # Load the coordinates of one spline indexed by index_pick_files, from its own file, as a view into a
+    # memory-mapped store, or by rasterizing its model every spacing px along its arc length, or at
+    # spline_density points if spacing is None
+    # If shape is given, pixels of a rasterized model outside a micrograph of that (rows, columns) shape
+    # are dropped, as a degenerate model can run far outside the micrograph
+    if isinstance(source, tuple) and source[0] == "store":
+        kind, path, start, end = source
+        return np.load(path, mmap_mode='r')[start:end]
+    model = load_spline_model(source)
+    if model is not None:
+        spline = rasterize_spline(*model, spline_density, spacing)
+        if shape is not None:
+            spline = spline[np.all((spline >= 0) & (spline < (shape[1], shape[0])), axis=1)]
+        return spline
+    return np.load(source)
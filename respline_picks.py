@@ -1,59 +1,124 @@
 import numpy as np
 from argparse import ArgumentParser
-from scipy.interpolate import splprep, splev
+from scipy.interpolate import splprep
+from membrane_pipeline import map_micrographs, save_atomic
+from pick_store import index_pick_files, load_pick_array, load_spline_model
+from membrane_refinement import sample_spline, rasterize_spline
 import os
 from pathlib import Path
 
-# Parse command line arguments
-parser = ArgumentParser(
-    prog="respline_picks.py",
-    description="Fit a spline to coordinates and return the number of specified points on the spline"
-)
-parser.add_argument(
-    "--input_dir",
-    type=str,
-    default=".",
-    help="Directory containing np arrays of edge coordinates"
-)
-parser.add_argument(
-    "--spline_density",
-    type=int,
-    default=20000,
-    help="Number of points to pick from each spline fit to a vesicle"
-)
-parser.add_argument(
-    "--spline_dir",
-    type=str,
-    default=None,
-    help="Path to save np array of final membrane spline coordinates"
-)
-
-args = parser.parse_args()
-input_dir = args.input_dir
-spline_density = args.spline_density
-spline_dir = args.spline_dir
-
-input_dir_files = [entry for entry in os.scandir(input_dir) if entry.is_file()]
-for input_file in input_dir_files:
-    # Skip non .npy files
-    if not input_file.name.endswith(".npy"):
-        continue
-    # Load points from file
-    points = np.load(input_file.path)
-    # Sort points by angle
-    points_angles = np.arctan2(points[:, 1] - np.mean(points[:, 1]), 
-                               points[:, 0] - np.mean(points[:, 0]))
-    points = points[np.argsort(points_angles), :]
-    # Generate a spline through the points
-    try:
-        tck, u = splprep([points[:, 0], points[:, 1]], k=3)
-    except Exception as e:
-        print(f"File {input_file.name} has error {e}")
-    
-    spline = splev(np.linspace(0, 1.0, spline_density), tck)
-    spline = np.unique(np.round(spline).astype(int).T, axis=0)
-    
-    # Save spline points to file
-    spline_dir = Path(spline_dir)
-    np.save(spline_dir / input_file.name, spline)
 
+def parse_args():
+    # Parse command line arguments
+    parser = ArgumentParser(
+        prog="respline_picks.py",
+        description="Fit a spline to coordinates and return the number of specified points on the spline"
+    )
+    parser.add_argument(
+        "--input_dir",
+        type=str,
+        default=".",
+        help="Directory containing np arrays of edge coordinates, named {uid}_vesicle_{index}_{layer}.npy, or stores of each micrograph's coordinates or spline models"
+    )
+    parser.add_argument(
+        "--spline_density",
+        type=int,
+        default=20000,
+        help="Number of points to pick from each spline fit to a vesicle"
+    )
+    parser.add_argument(
+        "--spline_spacing",
+        type=float,
+        default=None,
+        help="Spacing in A between points picked along each spline's arc length, instead of --spline_density points. Spacings up to the pixel size pick every pixel the spline passes through"
+    )
+    parser.add_argument(
+        "--psize",
+        type=float,
+        default=None,
+        help="Width of each pixel in A, required with --spline_spacing"
+    )
+    parser.add_argument(
+        "--spline_dir",
+        type=str,
+        default=None,
+        help="Path to save np array of final membrane spline coordinates"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes fitting micrographs' splines in parallel"
+    )
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Skip arrays whose spline output already exists, to resume an interrupted run"
+    )
+    args = parser.parse_args()
+    if args.spline_spacing is not None and args.psize is None:
+        parser.error("--psize is required with --spline_spacing")
+    return args
+
+# Per process state for fitting splines, set by init_worker
+worker_state = {}
+
+def init_worker(args):
+    # Store the arguments once in each process fitting splines
+    worker_state["args"] = args
+    worker_state["spline_spacing"] = None if args.spline_spacing is None else args.spline_spacing / args.psize
+
+def load_points(uid, vesicles):
+    # Load the coordinate arrays of all vesicles of one micrograph
+    # Returns a list of (file name, points), where spline models are loaded in place of their points,
+    # skipping arrays already resplined if requested
+    args = worker_state["args"]
+    loaded = []
+    for index in sorted(vesicles):
+        for layer, source in sorted(vesicles[index].items()):
+            name = f"{uid}_vesicle_{index}_{layer}.npy"
+            if args.skip_existing and os.path.isfile(Path(args.spline_dir) / name):
+                continue
+            model = load_spline_model(source)
+            loaded.append((name, load_pick_array(source) if model is None else model))
+    return loaded
+
+def respline_points(uid, vesicles, loaded):
+    # Fit and save a spline through each loaded coordinate array of one micrograph, or resample each
+    # loaded spline model without refitting
+    args = worker_state["args"]
+    for name, points in loaded:
+        if isinstance(points, tuple):
+            spline = rasterize_spline(*points, args.spline_density, worker_state["spline_spacing"])
+            save_atomic(Path(args.spline_dir) / name, np.save, spline)
+            continue
+        # Sort points by angle
+        points_angles = np.arctan2(points[:, 1] - np.mean(points[:, 1]),
+                                   points[:, 0] - np.mean(points[:, 0]))
+        points = points[np.argsort(points_angles), :]
+        # Generate a spline through the points
+        try:
+            tck, u = splprep([points[:, 0], points[:, 1]], k=3)
+        except Exception as e:
+            print(f"File {name} has error {e}")
+            continue
+
+        spline, _ = sample_spline(tck, args.spline_density, worker_state["spline_spacing"])
+
+        # Save spline points to file
+        save_atomic(Path(args.spline_dir) / name, np.save, spline)
+
+def main():
+    args = parse_args()
+    init_worker(args)
+
+    # Index the arrays by micrograph once, and respline each micrograph's arrays as one task
+    index = index_pick_files(args.input_dir)
+    tasks = [(uid, index[uid]) for uid in sorted(index)]
+    for _ in map_micrographs(load_points, respline_points, tasks, args.workers,
+                             initializer=init_worker, initargs=(args,)):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Push picks saved by pick_membrane.py or repick_membrane.py with --local to
+# cryoSPARC, as the outputs of a new external job
+
+
+# Imports
+from vesicle_picker import helpers, external_import
+from cryosparc.tools import Dataset
+from pick_export import push_picks
+from argparse import ArgumentParser
+from pathlib import Path
+
+
+def parse_args():
+    # Parse command line arguments
+    parser = ArgumentParser(
+        prog="upload_picks.py",
+        description="Push picks saved with --local to cryoSPARC"
+    )
+    parser.add_argument(
+        "parameters",
+        type=str,
+        help="Path to .ini file containing parameters for vesicle picking"
+    )
+    parser.add_argument(
+        "picks",
+        type=str,
+        nargs="+",
+        help="{output}.cs files saved to --output_dir, each pushed as the particle output of that name"
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    parameters = helpers.read_config(args.parameters)
+
+    # Initialize a cryosparc session and open the project
+    cs = external_import.load_cryosparc(parameters.get('csparc_input', 'login'))
+    project = cs.find_project(parameters.get('csparc_input', 'PID'))
+
+    # Push each file's picks as the output named by the file
+    vesicle_picks = {Path(path).stem: Dataset.load(path) for path in args.picks}
+    push_picks(project, parameters.get('csparc_input', 'WID'), vesicle_picks)
+
+
+if __name__ == "__main__":
+    main()